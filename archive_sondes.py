@@ -0,0 +1,142 @@
+import fnmatch
+import functools
+import gzip
+import hashlib
+import os
+import tarfile
+import zipfile
+
+
+# Read EDT files straight out of the compressed bundles they are archived and shipped in, without extracting
+# them to disk. A raw EDT "file name" can be
+#
+#     .../edt1sdataforv217_20230612_110000.txt          a plain file
+#     .../edt1sdataforv217_20230612_110000.txt.gz       a gzipped file
+#     .../Ash_Farm.zip::edt1sdataforv217_20230612_110000.txt
+#     .../Ash_Farm.tar.gz::2023/edt1sdataforv217_20230612_110000.txt
+#                                                       a member of a zip or (optionally compressed) tar archive
+#
+# and read_edt_source returns its decompressed bytes, ready for the reader's in-memory header and CSV parsing.
+# The file name part after the separator keeps the EDT naming, so the release time can still be read from it.
+ARCHIVE_MEMBER_SEPARATOR = '::'
+ZIP_SUFFIXES = ('.zip',)
+TAR_SUFFIXES = ('.tar', '.tar.gz', '.tgz', '.tar.bz2', '.tbz2', '.tar.xz', '.txz')
+
+# Open archives, kept per process so converting many members of one archive doesn't reopen it each time.
+# Compressed tars can only be read forwards cheaply, so a tar is kept positioned after the last member read
+# and the next member is found by carrying on from there; reading members in archive order (the order
+# list_archive_members gives) decompresses each archive once.
+MAX_OPEN_ARCHIVES = 4
+_open_archives = {}
+# Member lists are only a few names per archive, so many more are kept: enough for every archive in a raw tree
+# the watcher polls, which would otherwise decompress each .tar.gz on every poll just to list it
+MAX_LISTED_ARCHIVES = 1024
+
+
+def is_archive(file_name):
+    return file_name.endswith(ZIP_SUFFIXES + TAR_SUFFIXES)
+
+
+def split_source(file_name):
+    # (archive path, member name), or (file_name, None) for a file on disk
+    if ARCHIVE_MEMBER_SEPARATOR in file_name:
+        archive_path, member_name = file_name.split(ARCHIVE_MEMBER_SEPARATOR, 1)
+        return archive_path, member_name
+    return file_name, None
+
+
+def edt_base_name(file_name):
+    # The EDT file's own name, without any directory or archive path
+    archive_path, member_name = split_source(file_name)
+    return os.path.basename(member_name or archive_path)
+
+
+def list_archive_members(archive_path, pattern):
+    # Source names of the archive members whose base name matches pattern, in archive order
+    stat = os.stat(archive_path)
+    return [f"{archive_path}{ARCHIVE_MEMBER_SEPARATOR}{member_name}"
+            for member_name in _archive_member_names(archive_path, stat.st_mtime_ns, stat.st_size)
+            if fnmatch.fnmatch(os.path.basename(member_name), pattern)]
+
+
+@functools.lru_cache(maxsize=MAX_LISTED_ARCHIVES)
+def _archive_member_names(archive_path, mtime_ns, size):
+    # Listed once per archive version, per process
+    if archive_path.endswith(ZIP_SUFFIXES):
+        with zipfile.ZipFile(archive_path) as archive:
+            return tuple(info.filename for info in archive.infolist() if not info.is_dir())
+    with tarfile.open(archive_path, 'r:*') as archive:
+        return tuple(member.name for member in archive if member.isfile())
+
+
+def _open_archive(archive_path):
+    stat = os.stat(archive_path)
+    key = (archive_path, stat.st_mtime_ns, stat.st_size)
+    if key not in _open_archives:
+        if len(_open_archives) >= MAX_OPEN_ARCHIVES:
+            _open_archives.pop(next(iter(_open_archives))).close()
+        _open_archives[key] = (zipfile.ZipFile(archive_path) if archive_path.endswith(ZIP_SUFFIXES)
+                               else tarfile.open(archive_path, 'r:*'))
+    return key, _open_archives[key]
+
+
+def _read_tar_member(key, archive, member_name):
+    # Carry on through the tar from where the last read left it; if the member isn't found before the end, start
+    # again from the beginning once
+    for _ in range(2):
+        member = archive.next()
+        while member is not None:
+            if member.name == member_name:
+                return archive.extractfile(member).read()
+            member = archive.next()
+        archive.close()
+        archive = _open_archives[key] = tarfile.open(key[0], 'r:*')
+    raise KeyError(f"{member_name} not found in {key[0]}")
+
+
+def read_edt_source(file_name):
+    # The decompressed bytes of a plain, gzipped or archived EDT file
+    archive_path, member_name = split_source(file_name)
+    if member_name is None:
+        if file_name.endswith('.gz'):
+            with gzip.open(file_name, 'rb') as f:
+                return f.read()
+        with open(file_name, 'rb') as f:
+            return f.read()
+
+    key, archive = _open_archive(archive_path)
+    if isinstance(archive, zipfile.ZipFile):
+        return archive.read(member_name)
+    return _read_tar_member(key, archive, member_name)
+
+
+def source_size_mtime(file_name):
+    # Size and mtime (ns) to tell whether a source has changed: for an archive member, the member's own size
+    # and the archive's mtime
+    archive_path, member_name = split_source(file_name)
+    stat = os.stat(archive_path)
+    if member_name is None:
+        return stat.st_size, stat.st_mtime_ns
+    if archive_path.endswith(ZIP_SUFFIXES):
+        with zipfile.ZipFile(archive_path) as archive:
+            return archive.getinfo(member_name).file_size, stat.st_mtime_ns
+    return _tar_member_sizes(archive_path, stat.st_mtime_ns, stat.st_size)[member_name], stat.st_mtime_ns
+
+
+@functools.lru_cache(maxsize=MAX_OPEN_ARCHIVES)
+def _tar_member_sizes(archive_path, mtime_ns, size):
+    # A tar has no index, so read all its headers once (per archive version, per process)
+    with tarfile.open(archive_path, 'r:*') as archive:
+        return {member.name: member.size for member in archive if member.isfile()}
+
+
+def source_sha256(file_name):
+    archive_path, member_name = split_source(file_name)
+    sha256 = hashlib.sha256()
+    if member_name is None:
+        with open(file_name, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                sha256.update(block)
+    else:
+        sha256.update(read_edt_source(file_name))
+    return sha256.hexdigest()
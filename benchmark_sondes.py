@@ -0,0 +1,146 @@
+import contextlib
+import io
+import json
+import os
+import resource
+import tempfile
+import time
+
+from read_sondes import do_radiosondes, SONDE_COLUMN_TYPES
+from generate_edt_sondes import generate_synthetic_campaign
+from instrument_sondes import peak_rss_mb
+import archive_sondes
+import save_netcdf_sondes
+
+
+# Benchmark the conversion pipeline on a synthetic (or real) campaign. Per file it times the three stages
+# separately: read (do_radiosondes), convert (the column preparation and statistics save_netcdf_file does in
+# memory) and write (save_netcdf_file as a whole, so it includes its own convert step). It then times the
+# whole campaign through convert_sondes_to_netcdf, optionally with a process pool.
+
+
+def directory_size(directory):
+    return sum(os.path.getsize(os.path.join(root, name)) for root, _, names in os.walk(directory) for name in names)
+
+
+def benchmark_files(edt_file_list, netcdf_dir, compression=None):
+    records = []
+    for current_edt_file in edt_file_list:
+        record = {'file': current_edt_file, 'input_bytes': archive_sondes.source_size_mtime(current_edt_file)[0]}
+
+        start = time.perf_counter()
+        df, radiosonde_metadata, data_units = do_radiosondes(current_edt_file, netcdf_dir,
+                                                             columns=list(SONDE_COLUMN_TYPES))
+        record['read_s'] = time.perf_counter() - start
+        record['rows'] = len(df)
+
+        start = time.perf_counter()
+        sonde_system_info = save_netcdf_sondes.SondeInfo(radiosonde_metadata['Station name'])
+        prepared_df = save_netcdf_sondes.prepare_sonde_columns(
+            df, radiosonde_metadata, recreate_elapsed_time=sonde_system_info.station_name == 'reading')
+        save_netcdf_sondes.column_statistics(prepared_df, list(save_netcdf_sondes.VARIABLE_COLUMNS.values()))
+        record['convert_s'] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            nc_path = save_netcdf_sondes.save_netcdf_file(df, radiosonde_metadata, netcdf_dir,
+                                                          archive_sondes.edt_base_name(current_edt_file), compression)
+        record['write_s'] = time.perf_counter() - start
+        record['output_bytes'] = os.path.getsize(nc_path)
+        record['masked_valid_samples'] = save_netcdf_sondes.count_masked_valid_samples(nc_path)
+        records.append(record)
+    return records
+
+
+def summarise_files(records):
+    n_files = len(records)
+    rows = sum(record['rows'] for record in records)
+    input_mb = sum(record['input_bytes'] for record in records) / 1e6
+    summary = {'files': n_files, 'rows': rows, 'input_mb': input_mb,
+               'output_mb': sum(record['output_bytes'] for record in records) / 1e6,
+               'masked_valid_samples': sum(sum(record['masked_valid_samples'].values()) for record in records)}
+    for stage in ['read', 'convert', 'write']:
+        total_s = sum(record[f'{stage}_s'] for record in records)
+        summary[stage] = {
+            'total_s': total_s,
+            'per_file_ms': 1000 * total_s / n_files,
+            'rows_per_s': rows / total_s,
+            'input_mb_per_s': input_mb / total_s,
+        }
+    return summary
+
+
+def benchmark_campaign(raw_dir, netcdf_dir, workers=1, compression=None):
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        summary = save_netcdf_sondes.convert_sondes_to_netcdf(raw_dir, netcdf_dir, workers=workers,
+                                                              compression=compression)
+    elapsed = time.perf_counter() - start
+    input_mb = sum(archive_sondes.source_size_mtime(result['file'])[0] for result in summary) / 1e6
+    return {
+        'workers': workers,
+        'files': len(summary),
+        'failed': sum(result['error'] is not None for result in summary),
+        'total_s': elapsed,
+        'files_per_s': len(summary) / elapsed,
+        'input_mb_per_s': input_mb / elapsed,
+        'output_mb': directory_size(netcdf_dir) / 1e6,
+    }
+
+
+def print_report(report):
+    files = report['per_file']
+    print(f"{files['files']} files, {files['rows']} rows, {files['input_mb']:.1f} MB EDT in, "
+          f"{files['output_mb']:.1f} MB NetCDF out ({files['input_mb'] / files['output_mb']:.1f}x smaller)")
+    print(f"{'stage':<10}{'ms/file':>10}{'rows/s':>14}{'MB/s':>10}")
+    for stage in ['read', 'convert', 'write']:
+        print(f"{stage:<10}{files[stage]['per_file_ms']:>10.1f}{files[stage]['rows_per_s']:>14.0f}"
+              f"{files[stage]['input_mb_per_s']:>10.1f}")
+    for campaign in report['campaign']:
+        print(f"campaign, {campaign['workers']} worker(s): {campaign['total_s']:.2f} s, "
+              f"{campaign['files_per_s']:.1f} files/s, {campaign['input_mb_per_s']:.1f} MB/s, "
+              f"{campaign['failed']} failed")
+    if files['masked_valid_samples']:
+        print(f"WARNING: {files['masked_valid_samples']} written samples fall outside valid_min/valid_max and "
+              f"read back as missing")
+    print(f"peak RSS: {report['peak_rss_mb']:.0f} MB (benchmark process), "
+          f"{report['peak_rss_children_mb']:.0f} MB (largest worker)")
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Benchmark reading, converting and writing radiosonde files.')
+    parser.add_argument('--raw-dir', help='benchmark an existing raw directory instead of a synthetic campaign')
+    parser.add_argument('--sondes-per-station', type=int, default=10,
+                        help='synthetic sondes per station (default: 10, 50 files in total)')
+    parser.add_argument('--duration', type=int, default=7200, help='synthetic ascent length in seconds')
+    parser.add_argument('--workers', type=int, nargs='+', default=[1],
+                        help='worker counts to time the whole campaign with, e.g. --workers 1 2 4')
+    parser.add_argument('--compression', choices=sorted(save_netcdf_sondes.COMPRESSION_PROFILES), default='default')
+    parser.add_argument('--json', help='also write the full report, including per-file timings, to this file')
+    args = parser.parse_args()
+
+    compression = save_netcdf_sondes.NetcdfCompression(args.compression)
+    with tempfile.TemporaryDirectory() as scratch_dir:
+        raw_dir = args.raw_dir
+        if raw_dir is None:
+            raw_dir = os.path.join(scratch_dir, 'raw')
+            generate_synthetic_campaign(raw_dir, args.sondes_per_station, duration=args.duration)
+
+        records = benchmark_files(save_netcdf_sondes.find_edt_files(raw_dir), os.path.join(scratch_dir, 'files'),
+                                  compression)
+        report = {
+            'per_file': summarise_files(records),
+            'campaign': [benchmark_campaign(raw_dir, os.path.join(scratch_dir, f'campaign_{workers}'), workers,
+                                            compression)
+                         for workers in args.workers],
+            'peak_rss_mb': peak_rss_mb(),
+            'peak_rss_children_mb': peak_rss_mb(resource.RUSAGE_CHILDREN),
+            'files': records,
+        }
+
+    print_report(report)
+    if args.json is not None:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=1)
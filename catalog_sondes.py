@@ -0,0 +1,190 @@
+import datetime as dt
+import json
+import os
+import sqlite3
+
+import polars as pl
+
+
+# A catalog of every converted sonde, one row each, kept in an SQLite database at the top of the NetCDF output
+# tree. The converter upserts a row for each file it writes, so finding the sondes for a station, date range,
+# sonde serial number or software version is a single indexed query rather than a glob and an open of every
+# NetCDF file. Rows are keyed on the output path, so reconverting a sonde replaces its row.
+CATALOG_FILENAME = 'woest_sondes_catalog.sqlite'
+
+# Catalog column -> key in radiosonde_metadata, for the header fields worth querying on. The full metadata
+# block is also kept, as JSON, in the metadata column.
+METADATA_COLUMNS = {
+    'site_name': 'Station name',
+    'system_model': 'System trademark and model',
+    'software_version': 'Software version',
+    'sonde_type': 'Sonde type',
+    'sonde_serial_number': 'Sonde serial number',
+    'sonde_software_version': 'Sonde software version',
+    'release_point_height': 'Release point height from sea level',
+    'release_point_latitude': 'Release point latitude',
+    'release_point_longitude': 'Release point longitude',
+}
+
+# Times are stored as seconds since 1970-01-01 UTC so range queries compare numbers
+CATALOG_SCHEMA = f"""
+CREATE TABLE IF NOT EXISTS sondes (
+    output TEXT PRIMARY KEY,
+    raw_data_file TEXT,
+    station_name TEXT,
+    instrument_name TEXT,
+    {', '.join(f'{column} TEXT' for column in METADATA_COLUMNS)},
+    release_time REAL,
+    time_coverage_start REAL,
+    time_coverage_end REAL,
+    latitude_min REAL,
+    latitude_max REAL,
+    longitude_min REAL,
+    longitude_max REAL,
+    altitude_max REAL,
+    rows INTEGER,
+    product_version TEXT,
+    converted_at TEXT,
+    metadata TEXT
+);
+CREATE INDEX IF NOT EXISTS sondes_station_time ON sondes (station_name, release_time);
+CREATE INDEX IF NOT EXISTS sondes_release_time ON sondes (release_time);
+CREATE INDEX IF NOT EXISTS sondes_serial_number ON sondes (sonde_serial_number);
+CREATE INDEX IF NOT EXISTS sondes_software_version ON sondes (software_version);
+"""
+
+
+def catalog_path(netcdf_dir):
+    return os.path.join(netcdf_dir, CATALOG_FILENAME)
+
+
+def to_epoch_seconds(value):
+    # Query bounds may be datetimes (naive ones are taken as UTC), ISO strings or epoch seconds
+    if value is None or isinstance(value, (int, float)):
+        return value
+    if isinstance(value, str):
+        value = dt.datetime.fromisoformat(value)
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=dt.timezone.utc)
+    return value.timestamp()
+
+
+def catalog_row(radiosonde_metadata, station_name, instrument_name, time_range, stats, rows, nc_path,
+                raw_data_file, product_version):
+    # One catalog row from what save_netcdf_file already has to hand: the reader's metadata, the time range and
+    # the per-column (min, max) statistics. Must stay picklable, as it travels back from the process pool.
+    row = {
+        'output': os.path.abspath(nc_path),
+        'raw_data_file': raw_data_file,
+        'station_name': station_name,
+        'instrument_name': instrument_name,
+    }
+    for column, metadata_key in METADATA_COLUMNS.items():
+        row[column] = radiosonde_metadata.get(metadata_key)
+    row['release_time'] = to_epoch_seconds(radiosonde_metadata['start_time_dt'])
+    row['time_coverage_start'] = float(time_range[0])
+    row['time_coverage_end'] = float(time_range[1])
+    row['latitude_min'], row['latitude_max'] = stats['Lat']
+    row['longitude_min'], row['longitude_max'] = stats['Lon']
+    row['altitude_max'] = stats['GpsHeightMSL'][1]
+    row['rows'] = rows
+    row['product_version'] = product_version
+    row['converted_at'] = dt.datetime.now(dt.timezone.utc).strftime('%Y-%m-%dT%H:%M:%S')
+    row['metadata'] = json.dumps({key: value for key, value in radiosonde_metadata.items()
+                                  if isinstance(value, str)}, sort_keys=True)
+    return row
+
+
+class SondeCatalog:
+
+    def __init__(self, netcdf_dir):
+        os.makedirs(netcdf_dir, exist_ok=True)
+        self.connection = sqlite3.connect(catalog_path(netcdf_dir))
+        self.connection.executescript(CATALOG_SCHEMA)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        self.connection.close()
+
+    def upsert(self, rows):
+        rows = list(rows)
+        if not rows:
+            return
+        columns = list(rows[0])
+        with self.connection:
+            self.connection.executemany(
+                f"INSERT OR REPLACE INTO sondes ({', '.join(columns)}) "
+                f"VALUES ({', '.join(':' + column for column in columns)})", rows)
+
+    def remove_missing(self):
+        # Drop rows whose NetCDF file no longer exists; returns how many were dropped
+        missing = [(output,) for (output,) in self.connection.execute("SELECT output FROM sondes")
+                   if not os.path.exists(output)]
+        with self.connection:
+            self.connection.executemany("DELETE FROM sondes WHERE output = ?", missing)
+        return len(missing)
+
+    def query(self, station=None, start=None, end=None, serial_number=None, software_version=None,
+              sonde_type=None):
+        # Sondes matching every given filter, ordered by release time. start and end bound the release time
+        # (inclusive); station is the output station name, e.g. 'ash-farm'.
+        conditions = []
+        parameters = []
+        for column, value in [('station_name', station), ('sonde_serial_number', serial_number),
+                              ('software_version', software_version), ('sonde_type', sonde_type)]:
+            if value is not None:
+                conditions.append(f"{column} = ?")
+                parameters.append(value)
+        if start is not None:
+            conditions.append("release_time >= ?")
+            parameters.append(to_epoch_seconds(start))
+        if end is not None:
+            conditions.append("release_time <= ?")
+            parameters.append(to_epoch_seconds(end))
+        where = f" WHERE {' AND '.join(conditions)}" if conditions else ""
+        cursor = self.connection.execute(f"SELECT * FROM sondes{where} ORDER BY release_time, station_name",
+                                         parameters)
+        columns = [description[0] for description in cursor.description]
+        df = pl.DataFrame(cursor.fetchall(), schema=columns, orient='row', infer_schema_length=None)
+        return df.with_columns(
+            pl.from_epoch(pl.col(column).cast(pl.Float64).mul(1e6).cast(pl.Int64), time_unit='us')
+            for column in ['release_time', 'time_coverage_start', 'time_coverage_end'])
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Query the catalog of converted radiosondes.')
+    parser.add_argument('netcdf_dir', help='root of the NetCDF output tree holding the catalog')
+    parser.add_argument('--station', help="output station name, e.g. 'ash-farm'")
+    parser.add_argument('--start', help='earliest release time, ISO format (UTC)')
+    parser.add_argument('--end', help='latest release time, ISO format (UTC)')
+    parser.add_argument('--serial-number', help='sonde serial number')
+    parser.add_argument('--software-version', help="sounding system software version, e.g. 'MW41 2.17.0'")
+    parser.add_argument('--sonde-type', help="e.g. 'RS41-SGP'")
+    parser.add_argument('--paths', action='store_true', help='only print the matching NetCDF paths')
+    parser.add_argument('--parquet', help='write the matching rows to this Parquet file')
+    parser.add_argument('--remove-missing', action='store_true',
+                        help='first drop rows whose NetCDF file no longer exists')
+    args = parser.parse_args()
+
+    with SondeCatalog(args.netcdf_dir) as catalog:
+        if args.remove_missing:
+            print(f"Removed {catalog.remove_missing()} rows for missing files")
+        df = catalog.query(station=args.station, start=args.start, end=args.end, serial_number=args.serial_number,
+                           software_version=args.software_version, sonde_type=args.sonde_type)
+
+    if args.parquet is not None:
+        df.write_parquet(args.parquet)
+    if args.paths:
+        for output in df['output']:
+            print(output)
+    else:
+        with pl.Config(tbl_rows=-1, tbl_cols=-1):
+            print(df.select('station_name', 'release_time', 'sonde_serial_number', 'software_version', 'rows',
+                            'altitude_max', 'output'))
@@ -0,0 +1,220 @@
+import numpy as np
+import polars as pl
+
+
+# Derived thermodynamic and wind quantities for prepared sondes (after prepare_sonde_columns, so with TempK).
+# Per-level quantities are polars expressions evaluated over a whole batch of sondes concatenated together; the
+# surface parcel (LCL, CAPE, CIN) is computed on the batch packed into NaN-padded (sonde, level) arrays, so
+# every step is one NumPy operation over the whole batch rather than a Python loop per sonde or level.
+#
+# Formulae are from Bolton (1980), The computation of equivalent potential temperature, Mon. Wea. Rev. 108,
+# 1046-1053: saturation vapour pressure (eq. 10), dew point (its inverse), LCL temperature (eq. 15) and
+# equivalent potential temperature (eq. 43). The parcel is lifted dry-adiabatically to the LCL and then along
+# the pseudo-adiabat of constant equivalent potential temperature.
+
+RD = 287.04  # J kg-1 K-1, gas constant for dry air
+KAPPA = 0.2854  # Rd / cp
+EPSILON = 0.622  # Rd / Rv
+ZERO_CELSIUS = 273.15
+
+# Derived NetCDF variable -> (column, units, standard_name, long_name)
+DERIVED_VARIABLES = {
+    'dew_point_temperature': ('DewpK', 'K', 'dew_point_temperature', 'Dew Point Temperature'),
+    'air_potential_temperature': ('Theta', 'K', 'air_potential_temperature', 'Potential Temperature'),
+    'equivalent_potential_temperature': ('ThetaE', 'K', 'equivalent_potential_temperature',
+                                         'Equivalent Potential Temperature'),
+    'humidity_mixing_ratio': ('MixingRatio', 'kg kg-1', 'humidity_mixing_ratio', 'Water Vapour Mixing Ratio'),
+    'eastward_wind': ('U', 'm s-1', 'eastward_wind', 'Eastward Wind Component'),
+    'northward_wind': ('V', 'm s-1', 'northward_wind', 'Northward Wind Component'),
+}
+# Surface parcel NetCDF variable -> (key in the parcel dict, units, standard_name, long_name)
+PARCEL_VARIABLES = {
+    'lcl_pressure': ('lcl_pressure', 'hPa', '', 'Surface Parcel Lifting Condensation Level Pressure'),
+    'lcl_temperature': ('lcl_temperature', 'K', '', 'Surface Parcel Lifting Condensation Level Temperature'),
+    'lcl_altitude': ('lcl_altitude', 'm', '', 'Surface Parcel Lifting Condensation Level Altitude'),
+    'cape': ('cape', 'J kg-1', 'atmosphere_convective_available_potential_energy',
+             'Surface Based Convective Available Potential Energy'),
+    'cin': ('cin', 'J kg-1', 'atmosphere_convective_inhibition', 'Surface Based Convective Inhibition'),
+}
+
+# Columns the parcel calculation packs into (sonde, level) arrays
+PARCEL_COLUMNS = ['P', 'TempK', 'MixingRatio', 'GpsHeightMSL']
+
+
+def saturation_vapour_pressure(temperature_k):
+    # hPa, over water
+    temperature_c = temperature_k - ZERO_CELSIUS
+    return 6.112 * np.exp(17.67 * temperature_c / (temperature_c + 243.5))
+
+
+def mixing_ratio(vapour_pressure, pressure):
+    return EPSILON * vapour_pressure / (pressure - vapour_pressure)
+
+
+def lcl_temperature(temperature_k, dew_point_k):
+    return 1 / (1 / (dew_point_k - 56) + np.log(temperature_k / dew_point_k) / 800) + 56
+
+
+def equivalent_potential_temperature(temperature_k, pressure, mixing_ratio_kg, temperature_lcl):
+    r = 1000 * mixing_ratio_kg  # g kg-1
+    return (temperature_k * (1000 / pressure) ** (KAPPA * (1 - 0.28e-3 * r))
+            * np.exp((3.376 / temperature_lcl - 0.00254) * r * (1 + 0.81e-3 * r)))
+
+
+def virtual_temperature(temperature_k, mixing_ratio_kg):
+    return temperature_k * (1 + mixing_ratio_kg / EPSILON) / (1 + mixing_ratio_kg)
+
+
+def derived_column_expressions():
+    # Polars expressions for the per-level derived columns; as numpy ufuncs apply elementwise to expressions,
+    # the helpers above serve both these and the parcel arrays
+    vapour_pressure = pl.col('RH') / 100 * saturation_vapour_pressure(pl.col('TempK'))
+    log_ratio = (vapour_pressure / 6.112).log()
+    dew_point = 243.5 * log_ratio / (17.67 - log_ratio) + ZERO_CELSIUS
+    return [
+        dew_point.alias('DewpK'),
+        (pl.col('TempK') * (1000 / pl.col('P')) ** KAPPA).alias('Theta'),
+        mixing_ratio(vapour_pressure, pl.col('P')).alias('MixingRatio'),
+    ] + wind_component_expressions()
+
+
+def wind_component_expressions():
+    # U and V from wind speed and the direction the wind blows from (so towards the opposite direction)
+    wind_from = pl.col('Dir').cast(pl.Float64).radians()
+    return [(-pl.col('Speed') * wind_from.sin()).alias('U'), (-pl.col('Speed') * wind_from.cos()).alias('V')]
+
+
+def add_derived_columns(df):
+    # Adds DewpK, Theta, ThetaE, MixingRatio, U and V. RH of zero gives a null dew point rather than -inf.
+    df = df.with_columns(derived_column_expressions()).with_columns(
+        pl.when(pl.col('DewpK').is_finite()).then(pl.col('DewpK')).alias('DewpK'))
+    return df.with_columns(
+        equivalent_potential_temperature(pl.col('TempK'), pl.col('P'), pl.col('MixingRatio'),
+                                         lcl_temperature(pl.col('TempK'), pl.col('DewpK'))).alias('ThetaE'))
+
+
+def pack_profiles(dfs, columns):
+    # Pack the rows of every sonde where all of `columns` are valid into NaN-padded (sonde, level) float64
+    # arrays, one per column. Also returns the number of valid levels per sonde.
+    valid_dfs = [df.select(pl.col(columns).cast(pl.Float64).fill_nan(None)).drop_nulls() for df in dfs]
+    lengths = np.array([len(df) for df in valid_dfs])
+    n_levels = max(1, lengths.max(initial=0))
+    level_mask = np.arange(n_levels) < lengths[:, None]
+    packed = {}
+    for column in columns:
+        values = np.full((len(dfs), n_levels), np.nan)
+        # Boolean-mask assignment fills row by row, so the concatenated values land in each sonde's row
+        values[level_mask] = np.concatenate([df[column].to_numpy() for df in valid_dfs] + [np.empty(0)])
+        packed[column] = values
+    return packed, lengths
+
+
+def pseudo_adiabat_temperature(theta_e, pressure, iterations=30):
+    # Temperature of saturated air at `pressure` with equivalent potential temperature theta_e, by bisection
+    # (theta_e of saturated air increases monotonically with temperature) over the whole array at once
+    # Both bounds give finite theta_e at any pressure; overflow in between just means too warm
+    low = np.full(pressure.shape, 150.0)
+    high = np.full(pressure.shape, 350.0)
+    for _ in range(iterations):
+        middle = (low + high) / 2
+        saturation_pressure = saturation_vapour_pressure(middle)
+        saturated_theta_e = equivalent_potential_temperature(
+            middle, pressure, mixing_ratio(saturation_pressure, pressure), middle)
+        # Where the saturation vapour pressure reaches the air pressure the mixing ratio is meaningless, and
+        # the temperature is certainly too high
+        too_warm = (saturated_theta_e > theta_e) | (saturation_pressure >= pressure)
+        high = np.where(too_warm, middle, high)
+        low = np.where(too_warm, low, middle)
+    return (low + high) / 2
+
+
+def surface_parcel(packed, lengths):
+    # LCL, CAPE and CIN of a parcel lifted from the lowest valid level of each sonde. packed is from
+    # pack_profiles(dfs, PARCEL_COLUMNS). CAPE is the positive buoyancy energy between the level of free
+    # convection (the first positively buoyant layer at or above the LCL) and the equilibrium level (the last
+    # one), so it is never negative: stable layers in between don't count against it. CIN is the negative
+    # buoyancy below the LFC. Sondes with no LFC get CAPE and CIN of 0. lengths are the valid levels per sonde,
+    # from pack_profiles: sondes with fewer than two have no profile to lift a parcel through, so every value is
+    # missing (NaN).
+    pressure = packed['P']
+    temperature = packed['TempK']
+    mixing_ratio_kg = packed['MixingRatio']
+    altitude = packed['GpsHeightMSL']
+    n_sondes = pressure.shape[0]
+    if pressure.shape[1] < 2:
+        # No sonde in the batch has a layer to integrate over
+        return {key: np.full(n_sondes, np.nan) for key, _, _, _ in PARCEL_VARIABLES.values()}
+    with np.errstate(invalid='ignore', divide='ignore', over='ignore'):
+        # Only use the ascent, up to the lowest pressure reached, in case the file carries on after burst
+        ascent_end = np.argmin(np.where(np.isnan(pressure), np.inf, pressure), axis=1)
+        ascending = np.arange(pressure.shape[1]) <= ascent_end[:, None]
+        pressure = np.where(ascending, pressure, np.nan)
+
+        surface_pressure = pressure[:, :1]
+        surface_temperature = temperature[:, :1]
+        surface_mixing_ratio = mixing_ratio_kg[:, :1]
+        surface_vapour_pressure = surface_mixing_ratio * surface_pressure / (EPSILON + surface_mixing_ratio)
+        log_ratio = np.log(surface_vapour_pressure / 6.112)
+        surface_dew_point = 243.5 * log_ratio / (17.67 - log_ratio) + ZERO_CELSIUS
+        temperature_lcl = lcl_temperature(surface_temperature, surface_dew_point)
+        pressure_lcl = surface_pressure * (temperature_lcl / surface_temperature) ** (1 / KAPPA)
+        theta_e = equivalent_potential_temperature(surface_temperature, surface_pressure, surface_mixing_ratio,
+                                                   temperature_lcl)
+
+        below_lcl = pressure > pressure_lcl
+        dry_temperature = surface_temperature * (pressure / surface_pressure) ** KAPPA
+        moist_temperature = pseudo_adiabat_temperature(theta_e, pressure)
+        parcel_temperature = np.where(below_lcl, dry_temperature, moist_temperature)
+        parcel_mixing_ratio = np.where(below_lcl, surface_mixing_ratio,
+                                       mixing_ratio(saturation_vapour_pressure(moist_temperature), pressure))
+        buoyancy = (virtual_temperature(parcel_temperature, parcel_mixing_ratio)
+                    - virtual_temperature(temperature, mixing_ratio_kg))
+
+        # Energy of each layer between consecutive levels: Rd * mean virtual temperature excess * d(ln p)
+        layer_energy = RD * (buoyancy[:, :-1] + buoyancy[:, 1:]) / 2 * np.log(pressure[:, :-1] / pressure[:, 1:])
+        layer_energy = np.nan_to_num(layer_energy, nan=0.0)
+        layer_index = np.arange(layer_energy.shape[1])
+        positive_above_lcl = (layer_energy > 0) & ~below_lcl[:, 1:]
+        has_lfc = positive_above_lcl.any(axis=1)
+        lfc_index = np.where(has_lfc, np.argmax(positive_above_lcl, axis=1), layer_energy.shape[1])
+        el_index = layer_energy.shape[1] - 1 - np.argmax((layer_energy > 0)[:, ::-1], axis=1)
+        convective = (layer_index >= lfc_index[:, None]) & (layer_index <= el_index[:, None])
+        cape = np.where(has_lfc, np.sum(np.where(convective & (layer_energy > 0), layer_energy, 0), axis=1), 0.0)
+        inhibiting = (layer_index < lfc_index[:, None]) & (layer_energy < 0)
+        cin = np.where(has_lfc, np.sum(np.where(inhibiting, layer_energy, 0), axis=1), 0.0)
+
+        # Altitude of the LCL, interpolated in ln p between the levels either side of it
+        above = np.argmax(~below_lcl & ~np.isnan(pressure), axis=1)
+        below = np.maximum(above - 1, 0)
+        rows = np.arange(n_sondes)
+        log_p = np.log(pressure)
+        fraction = np.clip((np.log(pressure_lcl[:, 0]) - log_p[rows, below])
+                           / (log_p[rows, above] - log_p[rows, below]), 0, 1)
+        lcl_altitude = altitude[rows, below] + np.nan_to_num(fraction) * (altitude[rows, above]
+                                                                          - altitude[rows, below])
+        lowest_pressure = np.min(np.where(np.isnan(pressure), np.inf, pressure), axis=1)
+        lcl_altitude = np.where(pressure_lcl[:, 0] >= lowest_pressure, lcl_altitude, np.nan)
+
+    parcel = {
+        'lcl_pressure': pressure_lcl[:, 0],
+        'lcl_temperature': temperature_lcl[:, 0],
+        'lcl_altitude': lcl_altitude,
+        'cape': cape,
+        'cin': cin,
+    }
+    return {key: np.where(lengths < 2, np.nan, values) for key, values in parcel.items()}
+
+
+def derive_thermodynamics(dfs):
+    # Derive every quantity for a batch of prepared sondes. Returns the sondes with the derived columns added and
+    # a list with each sonde's surface parcel values.
+    lengths = [len(df) for df in dfs]
+    # Sondes from different systems have their columns in different orders
+    batch = add_derived_columns(pl.concat(dfs, how='diagonal_relaxed'))
+    offsets = np.concatenate(([0], np.cumsum(lengths)))
+    derived_dfs = [batch.slice(offset, length) for offset, length in zip(offsets[:-1], lengths)]
+
+    packed, parcel_lengths = pack_profiles(derived_dfs, PARCEL_COLUMNS)
+    parcel = surface_parcel(packed, parcel_lengths)
+    parcels = [{key: float(values[index]) for key, values in parcel.items()} for index in range(len(dfs))]
+    return derived_dfs, parcels
@@ -0,0 +1,172 @@
+import datetime as dt
+import os
+
+import numpy as np
+
+
+# Synthetic Vaisala MW41 EDT 1 s files, for benchmarking and for exercising the reader without real data. The
+# layout follows the files the reader expects: a tab-separated metadata block, a column header line, a units
+# line and then one tab-separated row per sample, written with the charmap encoding.
+
+# Raw data directory for each station and the "Station name" its sounding system writes
+STATION_NAMES = {
+    'Ash_Farm': 'AshFarm',
+    'Chilbolton': 'Chilbolton',
+    'Larkhill': 'LAR_A',
+    'Reading': 'Reading',
+    'Spire_View': 'SpireView',
+}
+
+EDT_COLUMNS = ["Elapsed time", "TimeUTC", "P", "Temp", "RH", "HeightMSL", "GpsHeightMSL", "Lat", "Lon", "Dir",
+               "Speed", "AscRate", "Dewp"]
+EDT_UNITS = ["s", "hh:mm:ss", "hPa", "°C", "%", "m", "m", "deg", "deg", "deg", "m/s", "m/s", "°C"]
+EDT_FORMATS = ["%d", None, "%.2f", "%.2f", "%.1f", "%.1f", "%.1f", "%.6f", "%.6f", "%.0f", "%.2f", "%.2f", "%.2f"]
+
+MISSING_VALUE = "//////"
+# Columns that drop out together when the sonde loses its PTU or wind signal
+MISSING_VALUE_COLUMNS = [["Temp", "RH", "Dewp"], ["Dir", "Speed"], ["Lat", "Lon", "GpsHeightMSL", "Dir", "Speed"]]
+
+
+def edt_file_name(release_time):
+    return f"edt1sdataforv217_{release_time:%Y%m%d_%H%M%S}.txt"
+
+
+def synthetic_profile(duration, sampling_interval, release_height, latitude, longitude, rng):
+    # A plausible ascent: ~5 m/s with turbulence, a standard-atmosphere temperature profile with an isothermal
+    # stratosphere, random-walk humidity and winds, and the balloon drifting with the wind.
+    n_samples = int(duration // sampling_interval)
+    elapsed_time = np.arange(n_samples) * sampling_interval
+
+    ascent_rate = np.clip(5.0 + np.cumsum(rng.normal(0, 0.05, n_samples)) + rng.normal(0, 0.3, n_samples), 1, 9)
+    height = release_height + np.concatenate(([0], np.cumsum(ascent_rate[1:] * sampling_interval)))
+
+    temperature_k = np.maximum(288.15 - 0.0065 * height, 216.65) + np.cumsum(rng.normal(0, 0.02, n_samples))
+    scale_height = 29.27 * temperature_k
+    pressure = 1013.25 * np.exp(-np.concatenate(([0], np.cumsum(np.diff(height) / scale_height[1:]))))
+    pressure *= np.exp(-release_height / scale_height[0])
+    relative_humidity = np.clip(70 + np.cumsum(rng.normal(0, 0.3, n_samples)) - height / 400, 1, 100)
+
+    # Magnus formula dew point, in Celsius like the EDT files
+    temperature_c = temperature_k - 273.15
+    gamma = np.log(relative_humidity / 100) + 17.62 * temperature_c / (243.12 + temperature_c)
+    dew_point = 243.12 * gamma / (17.62 - gamma)
+
+    wind_speed = np.abs(8 + height / 1000 + np.cumsum(rng.normal(0, 0.05, n_samples)))
+    wind_direction = (240 + np.cumsum(rng.normal(0, 0.2, n_samples))) % 360
+    # Wind *from* wind_direction blows the balloon the opposite way
+    north = np.cumsum(-wind_speed * np.cos(np.radians(wind_direction))) * sampling_interval
+    east = np.cumsum(-wind_speed * np.sin(np.radians(wind_direction))) * sampling_interval
+    sonde_latitude = latitude + north / 111_320
+    sonde_longitude = longitude + east / (111_320 * np.cos(np.radians(latitude)))
+
+    return {
+        "Elapsed time": elapsed_time,
+        "P": pressure,
+        "Temp": temperature_c,
+        "RH": relative_humidity,
+        "HeightMSL": height,
+        "GpsHeightMSL": height + rng.normal(0, 2, n_samples),
+        "Lat": sonde_latitude,
+        "Lon": sonde_longitude,
+        "Dir": wind_direction,
+        "Speed": wind_speed,
+        "AscRate": ascent_rate,
+        "Dewp": dew_point,
+    }
+
+
+def write_synthetic_edt_file(raw_dir, station='Ash_Farm', release_time=dt.datetime(2023, 6, 12, 11, 0, 0),
+                             duration=7200, sampling_interval=1, reading_style=None, missing_runs=3,
+                             missing_run_length=60, seed=None):
+    # Write one synthetic EDT file into raw_dir/station and return its path. Reading-style files (the default
+    # for the Reading station) have no elapsed time column. Flights crossing midnight UTC just need a
+    # release_time close enough to midnight for the duration.
+    rng = np.random.default_rng(seed)
+    if reading_style is None:
+        reading_style = station == 'Reading'
+    release_height = 100.0
+    profile = synthetic_profile(duration, sampling_interval, release_height, 51.1, -1.3, rng)
+    n_samples = len(profile["P"])
+
+    formatted = {}
+    for column, column_format in zip(EDT_COLUMNS, EDT_FORMATS):
+        if column == "TimeUTC":
+            seconds_of_day = ((release_time.hour * 3600 + release_time.minute * 60 + release_time.second
+                               + profile["Elapsed time"]) % 86400).astype(np.int64)
+            formatted[column] = [f"{s // 3600:02d}:{s // 60 % 60:02d}:{s % 60:02d}" for s in seconds_of_day.tolist()]
+        else:
+            formatted[column] = np.char.mod(column_format, profile[column]).tolist()
+
+    # Drop out groups of columns for runs of samples, as Vaisala does with '//////'
+    for _ in range(missing_runs):
+        start = int(rng.integers(0, max(1, n_samples - missing_run_length)))
+        for column in MISSING_VALUE_COLUMNS[int(rng.integers(len(MISSING_VALUE_COLUMNS)))]:
+            formatted[column][start:start + missing_run_length] = [MISSING_VALUE] * len(
+                formatted[column][start:start + missing_run_length])
+
+    columns = EDT_COLUMNS[1:] if reading_style else EDT_COLUMNS
+    units = EDT_UNITS[1:] if reading_style else EDT_UNITS
+    # The first column name starts the line; the others are padded with a leading space, so the Reading-style
+    # header line starts " TimeUTC".
+    header_line = ("\t".join([columns[0]] + [f" {column}" for column in columns[1:]]) if not reading_style
+                   else "\t".join(f" {column}" for column in columns))
+
+    metadata = [
+        ("Station name", STATION_NAMES[station]),
+        ("System trademark and model", "Vaisala MW41"),
+        ("Software version", "MW41 2.17.0"),
+        ("Sonde type", "RS41-SGP"),
+        ("Sonde serial number", f"U{int(rng.integers(1_000_000, 9_999_999))}"),
+        ("Sonde software version", "1.4.12"),
+        ("Balloon release date and time", f"{release_time:%Y-%m-%dT%H:%M:%S}"),
+        ("Release point height from sea level", f"{release_height:.0f} m"),
+        ("Release point latitude", "51.100000"),
+        ("Release point longitude", "-1.300000"),
+    ]
+    lines = ["Vaisala MW41 EDT data", "Synthetic sounding generated for benchmarking", ""]
+    lines += [f"{key}\t{value}" for key, value in metadata]
+    lines += ["", header_line, "\t".join(units)]
+    lines += ["\t".join(row) for row in zip(*(formatted[column] for column in columns))]
+
+    os.makedirs(os.path.join(raw_dir, station), exist_ok=True)
+    file_name = os.path.join(raw_dir, station, edt_file_name(release_time))
+    with open(file_name, "w", encoding="charmap", newline="\n") as f:
+        f.write("\n".join(lines) + "\n")
+    return file_name
+
+
+def generate_synthetic_campaign(raw_dir, sondes_per_station=10, stations=None,
+                                first_release_time=dt.datetime(2023, 6, 12, 11, 0, 0), launch_interval_hours=6.5,
+                                duration=7200, sampling_interval=1, missing_runs=3, missing_run_length=60, seed=0):
+    # Write sondes_per_station launches for every station. The launch interval isn't a whole number of days,
+    # so release times drift round the clock and a campaign includes flights that cross midnight UTC.
+    stations = stations or list(STATION_NAMES)
+    file_names = []
+    for station_index, station in enumerate(stations):
+        for sonde_index in range(sondes_per_station):
+            release_time = first_release_time + dt.timedelta(hours=launch_interval_hours * sonde_index,
+                                                             minutes=7 * station_index)
+            file_names.append(write_synthetic_edt_file(
+                raw_dir, station, release_time.replace(microsecond=0), duration=duration,
+                sampling_interval=sampling_interval, missing_runs=missing_runs,
+                missing_run_length=missing_run_length, seed=seed + 1000 * station_index + sonde_index))
+    return file_names
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Write a synthetic campaign of Vaisala EDT radiosonde files.')
+    parser.add_argument('raw_dir', help='directory to write one sub-directory of EDT files per station into')
+    parser.add_argument('--sondes-per-station', type=int, default=10)
+    parser.add_argument('--stations', nargs='+', choices=list(STATION_NAMES), help='default: all stations')
+    parser.add_argument('--duration', type=int, default=7200, help='ascent length in seconds (default: 7200)')
+    parser.add_argument('--missing-runs', type=int, default=3, help="runs of '//////' missing values per file")
+    parser.add_argument('--missing-run-length', type=int, default=60, help='samples per missing value run')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    file_names = generate_synthetic_campaign(args.raw_dir, args.sondes_per_station, stations=args.stations,
+                                             duration=args.duration, missing_runs=args.missing_runs,
+                                             missing_run_length=args.missing_run_length, seed=args.seed)
+    print(f"Wrote {len(file_names)} EDT files to {args.raw_dir}")
@@ -0,0 +1,287 @@
+import glob
+import math
+import os
+import sqlite3
+
+import netCDF4 as nc
+import numpy as np
+import polars as pl
+
+from catalog_sondes import to_epoch_seconds
+
+
+# A spatio-temporal index over every observation in the per-sonde NetCDF files, kept in an SQLite R-tree next to
+# the catalog. Each sonde is cut into segments of SEGMENT_LENGTH consecutive observations and the index holds one
+# (longitude, latitude, altitude, time) bounding box per segment, with the file and the slice of it the segment
+# covers. A sonde ascends steadily, so its segments are small boxes and a query box touches only a few of them;
+# answering a query is one R-tree lookup and a read of just those slices, rather than opening every file.
+#
+# The boxes are built from the values as stored in the files (after any quantisation), the same values query()
+# reads back. The R-tree stores its coordinates as 32-bit floats, and SQLite rounds them to nearest (time, at
+# ~1.7e9 s, only has 128 s resolution), so segment_boxes rounds each box outwards to 32-bit floats itself. A box
+# can then only ever be a little too big: query() filters the slices it reads exactly, and never misses a point.
+INDEX_FILENAME = 'woest_sondes_index.sqlite'
+SEGMENT_LENGTH = 64
+
+# Index box dimension -> per-sonde NetCDF variable
+INDEX_VARIABLES = {
+    'longitude': 'longitude',
+    'latitude': 'latitude',
+    'altitude': 'altitude',
+    'time': 'time',
+}
+
+INDEX_SCHEMA = f"""
+CREATE TABLE IF NOT EXISTS files (
+    file_id INTEGER PRIMARY KEY,
+    output TEXT UNIQUE
+);
+CREATE VIRTUAL TABLE IF NOT EXISTS segments USING rtree(
+    segment_id,
+    {', '.join(f'{dimension}_min, {dimension}_max' for dimension in INDEX_VARIABLES)},
+    +file_id INTEGER,
+    +start INTEGER,
+    +stop INTEGER
+);
+"""
+
+EARTH_RADIUS_KM = 6371.0088
+
+
+def index_path(netcdf_dir):
+    return os.path.join(netcdf_dir, INDEX_FILENAME)
+
+
+def float32_bound(values, direction):
+    # values rounded to 32-bit floats towards direction (-inf for lower bounds, inf for upper ones), so the R-tree
+    # stores them exactly
+    rounded = values.astype(np.float32)
+    inward = rounded < values if direction > 0 else rounded > values
+    return np.where(inward, np.nextafter(rounded, np.float32(direction)), rounded).astype(np.float64)
+
+
+def segment_boxes(longitude, latitude, altitude, time, segment_length=SEGMENT_LENGTH):
+    # Bounding boxes of each run of segment_length observations, as picklable tuples of the R-tree columns
+    # followed by (start, stop). Each dimension is bounded by its own non-missing values, so an observation
+    # missing its altitude is still found by a query on time alone; a dimension with no values in a segment
+    # spans the whole float32 range, and query() filters those observations out exactly.
+    columns = [np.asarray(values, dtype=np.float64) for values in (longitude, latitude, altitude, time)]
+    starts = np.arange(0, len(columns[0]), segment_length)
+    if len(starts) == 0:
+        return []
+    float32_max = float(np.finfo(np.float32).max)
+    boxes = []
+    for values in columns:
+        # reduceat over each segment, with missing values replaced by the identity of the reduction
+        valid = np.isfinite(values)
+        has_values = np.add.reduceat(valid, starts) > 0
+        minimum = np.minimum.reduceat(np.where(valid, values, np.inf), starts)
+        maximum = np.maximum.reduceat(np.where(valid, values, -np.inf), starts)
+        boxes.append(np.where(has_values, float32_bound(minimum, -np.inf), -float32_max))
+        boxes.append(np.where(has_values, float32_bound(maximum, np.inf), float32_max))
+    stops = np.minimum(starts + segment_length, len(columns[0]))
+    return [tuple(float(bound[i]) for bound in boxes) + (int(starts[i]), int(stops[i])) for i in range(len(starts))]
+
+
+def read_segment_boxes(nc_path, segment_length=SEGMENT_LENGTH):
+    # Segment boxes of a per-sonde NetCDF file, from its stored values: used both as each file is written and to
+    # index files converted before the index existed
+    with nc.Dataset(nc_path) as dataset:
+        return segment_boxes(*(np.ma.filled(dataset[variable][:].astype(np.float64), np.nan)
+                               for variable in INDEX_VARIABLES.values()), segment_length)
+
+
+def great_circle_km(latitude, longitude, centre_latitude, centre_longitude):
+    latitude, longitude = np.radians(latitude), np.radians(longitude)
+    centre_latitude, centre_longitude = np.radians(centre_latitude), np.radians(centre_longitude)
+    a = (np.sin((latitude - centre_latitude) / 2) ** 2
+         + np.cos(latitude) * np.cos(centre_latitude) * np.sin((longitude - centre_longitude) / 2) ** 2)
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.clip(a, 0, 1)))
+
+
+def radius_box(centre_latitude, centre_longitude, radius_km):
+    # A (latitude, longitude) box containing every point within radius_km of the centre
+    latitude_delta = math.degrees(radius_km / EARTH_RADIUS_KM)
+    cos_latitude = math.cos(math.radians(min(abs(centre_latitude) + latitude_delta, 90.0)))
+    longitude_delta = 180.0 if cos_latitude < 1e-6 else min(180.0, latitude_delta / cos_latitude)
+    return ((centre_latitude - latitude_delta, centre_latitude + latitude_delta),
+            (centre_longitude - longitude_delta, centre_longitude + longitude_delta))
+
+
+def intersect_bounds(bounds, other):
+    # The overlap of two (min, max) ranges, where bounds may be None or have None (open) ends
+    if bounds is None:
+        return other
+    lower = other[0] if bounds[0] is None else max(bounds[0], other[0])
+    upper = other[1] if bounds[1] is None else min(bounds[1], other[1])
+    return lower, upper
+
+
+def merge_slices(slices):
+    # Sorted, with overlapping and touching (start, stop) slices joined, so each run is read in one go
+    merged = []
+    for start, stop in sorted(slices):
+        if merged and start <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], stop)
+        else:
+            merged.append([start, stop])
+    return merged
+
+
+class SondeIndex:
+
+    def __init__(self, netcdf_dir):
+        os.makedirs(netcdf_dir, exist_ok=True)
+        self.connection = sqlite3.connect(index_path(netcdf_dir))
+        self.connection.executescript(INDEX_SCHEMA)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        self.connection.close()
+
+    def _remove(self, output):
+        self.connection.execute(
+            "DELETE FROM segments WHERE file_id IN (SELECT file_id FROM files WHERE output = ?)", (output,))
+        self.connection.execute("DELETE FROM files WHERE output = ?", (output,))
+
+    def replace(self, entries):
+        # entries are (output path, segment boxes) pairs; a file's existing segments are replaced, so
+        # reconverting a sonde doesn't leave stale boxes behind
+        with self.connection:
+            for output, boxes in entries:
+                output = os.path.abspath(output)
+                self._remove(output)
+                file_id = self.connection.execute("INSERT INTO files (output) VALUES (?)", (output,)).lastrowid
+                self.connection.executemany(
+                    f"INSERT INTO segments VALUES (NULL, {', '.join(['?'] * (2 * len(INDEX_VARIABLES)))}, ?, ?, ?)",
+                    [box[:-2] + (file_id,) + box[-2:] for box in boxes])
+
+    def remove_missing(self):
+        # Drop the segments of files that no longer exist; returns how many files were dropped
+        missing = [output for (output,) in self.connection.execute("SELECT output FROM files")
+                   if not os.path.exists(output)]
+        with self.connection:
+            for output in missing:
+                self._remove(output)
+        return len(missing)
+
+    def rebuild(self, netcdf_dir):
+        # Index every per-sonde file under netcdf_dir (<station>/<year>/<month>/<day>/*.nc) from scratch
+        nc_paths = sorted(glob.glob(os.path.join(netcdf_dir, '*', '*', '*', '*', '*.nc')))
+        with self.connection:
+            self.connection.execute("DELETE FROM segments")
+            self.connection.execute("DELETE FROM files")
+        self.replace((nc_path, read_segment_boxes(nc_path)) for nc_path in nc_paths)
+        return len(nc_paths)
+
+    def matching_slices(self, latitude=None, longitude=None, altitude=None, time=None):
+        # {output path: merged [start, stop] slices} whose boxes overlap the query. Each argument is a
+        # (min, max) pair, either end of which may be None; time bounds may be datetimes, ISO strings or epoch
+        # seconds.
+        if time is not None:
+            time = tuple(to_epoch_seconds(value) for value in time)
+        conditions = []
+        parameters = []
+        for dimension, bounds in [('longitude', longitude), ('latitude', latitude), ('altitude', altitude),
+                                  ('time', time)]:
+            if bounds is None:
+                continue
+            lower, upper = bounds
+            if lower is not None:
+                conditions.append(f"{dimension}_max >= ?")
+                parameters.append(lower)
+            if upper is not None:
+                conditions.append(f"{dimension}_min <= ?")
+                parameters.append(upper)
+        where = f" WHERE {' AND '.join(conditions)}" if conditions else ""
+        slices = {}
+        for output, start, stop in self.connection.execute(
+                f"SELECT files.output, segments.start, segments.stop FROM segments "
+                f"JOIN files ON files.file_id = segments.file_id{where}", parameters):
+            slices.setdefault(output, []).append((start, stop))
+        return {output: merge_slices(output_slices) for output, output_slices in sorted(slices.items())}
+
+    def query(self, latitude=None, longitude=None, altitude=None, time=None, near=None, variables=None):
+        # Every observation inside the query box, as a DataFrame with the file, the observation's index in it and
+        # the requested variables (default: all the per-sonde data variables). near=(latitude, longitude,
+        # radius_km) keeps only observations within that great-circle distance, e.g. of a radar.
+        if near is not None:
+            near_latitude, near_longitude = radius_box(*near)
+            latitude = intersect_bounds(latitude, near_latitude)
+            longitude = intersect_bounds(longitude, near_longitude)
+        time = None if time is None else tuple(to_epoch_seconds(value) for value in time)
+
+        frames = []
+        for output, output_slices in self.matching_slices(latitude, longitude, altitude, time).items():
+            with nc.Dataset(output) as dataset:
+                names = variables or [name for name, variable in dataset.variables.items()
+                                      if variable.dimensions == ('time',)]
+                names = list(dict.fromkeys(list(INDEX_VARIABLES.values()) + list(names)))
+                for start, stop in output_slices:
+                    columns = {name: np.ma.filled(dataset[name][start:stop].astype(np.float64), np.nan)
+                               for name in names}
+                    keep = np.ones(stop - start, dtype=bool)
+                    for dimension, bounds in [('latitude', latitude), ('longitude', longitude),
+                                              ('altitude', altitude), ('time', time)]:
+                        if bounds is None:
+                            continue
+                        values = columns[INDEX_VARIABLES[dimension]]
+                        with np.errstate(invalid='ignore'):
+                            if bounds[0] is not None:
+                                keep &= values >= bounds[0]
+                            if bounds[1] is not None:
+                                keep &= values <= bounds[1]
+                    if near is not None:
+                        with np.errstate(invalid='ignore'):
+                            keep &= great_circle_km(columns['latitude'], columns['longitude'],
+                                                    near[0], near[1]) <= near[2]
+                    if not keep.any():
+                        continue
+                    frames.append(pl.DataFrame(
+                        {'output': np.full(keep.sum(), output), 'index': np.flatnonzero(keep) + start}
+                        | {name: values[keep] for name, values in columns.items()}))
+        if not frames:
+            return pl.DataFrame(schema={'output': pl.String, 'index': pl.Int64})
+        return pl.concat(frames, how='diagonal_relaxed')
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Find every radiosonde observation in a lat/lon box, altitude '
+                                                 'band and time window using the spatio-temporal index.')
+    parser.add_argument('netcdf_dir', help='root of the NetCDF output tree holding the index')
+    parser.add_argument('--latitude', type=float, nargs=2, metavar=('MIN', 'MAX'))
+    parser.add_argument('--longitude', type=float, nargs=2, metavar=('MIN', 'MAX'))
+    parser.add_argument('--altitude', type=float, nargs=2, metavar=('MIN', 'MAX'), help='metres above sea level')
+    parser.add_argument('--start', help='earliest observation time, ISO format (UTC)')
+    parser.add_argument('--end', help='latest observation time, ISO format (UTC)')
+    parser.add_argument('--near', type=float, nargs=3, metavar=('LATITUDE', 'LONGITUDE', 'RADIUS_KM'),
+                        help='only observations within this distance of a point')
+    parser.add_argument('--variables', nargs='+', help='NetCDF variables to return (default: all)')
+    parser.add_argument('--parquet', help='write the matching observations to this Parquet file')
+    parser.add_argument('--rebuild', action='store_true',
+                        help='first rebuild the index from every per-sonde NetCDF file in netcdf_dir')
+    parser.add_argument('--remove-missing', action='store_true',
+                        help='first drop the segments of NetCDF files that no longer exist')
+    args = parser.parse_args()
+
+    with SondeIndex(args.netcdf_dir) as index:
+        if args.rebuild:
+            print(f"Indexed {index.rebuild(args.netcdf_dir)} files")
+        if args.remove_missing:
+            print(f"Removed {index.remove_missing()} missing files from the index")
+        time_window = None if args.start is None and args.end is None else (args.start, args.end)
+        df = index.query(latitude=args.latitude, longitude=args.longitude, altitude=args.altitude, time=time_window,
+                         near=args.near, variables=args.variables)
+
+    if args.parquet is not None:
+        df.write_parquet(args.parquet)
+    print(f"{len(df)} observations in {df['output'].n_unique() if len(df) else 0} files")
+    with pl.Config(tbl_cols=-1):
+        print(df)
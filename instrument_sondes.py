@@ -0,0 +1,96 @@
+import contextlib
+import csv
+import json
+import resource
+import sys
+import time
+
+
+# Optional per-stage instrumentation for the conversion pipeline. Code marks its stages with
+#
+#     with instrument_sondes.stage('read_csv') as record:
+#         ...
+#         record['rows'] = len(df)
+#
+# which costs one global lookup and a throwaway dict when profiling is off. When it is on, every stage appends a
+# record with its wall time, the counters the stage filled in (rows, bytes_read, bytes_written) and the process
+# peak RSS so far.
+# Stages inherit the file of the stage they are nested in.
+
+REPORT_FIELDS = ['stage', 'file', 'wall_s', 'rows', 'bytes_read', 'bytes_written', 'peak_rss_mb']
+
+_active_profile = None
+
+
+def peak_rss_mb(who=resource.RUSAGE_SELF):
+    # ru_maxrss is in kilobytes on Linux but bytes on macOS
+    peak_rss = resource.getrusage(who).ru_maxrss
+    return peak_rss / (1024 * 1024 if sys.platform == 'darwin' else 1024)
+
+
+class PipelineProfile:
+
+    def __init__(self):
+        self.records = []
+        self._stack = []
+
+    @contextlib.contextmanager
+    def stage(self, name, file=None):
+        if file is None and self._stack:
+            file = self._stack[-1]['file']
+        record = {'stage': name, 'file': file, 'rows': None, 'bytes_read': None, 'bytes_written': None}
+        self._stack.append(record)
+        start = time.perf_counter()
+        try:
+            yield record
+        finally:
+            record['wall_s'] = time.perf_counter() - start
+            record['peak_rss_mb'] = peak_rss_mb()
+            self._stack.pop()
+            self.records.append(record)
+
+
+def stage(name, file=None):
+    if _active_profile is None:
+        # A fresh record each time, so counters written with profiling off don't pile up in shared state
+        return contextlib.nullcontext({})
+    return _active_profile.stage(name, file)
+
+
+def start_profiling():
+    global _active_profile
+    _active_profile = PipelineProfile()
+
+
+def stop_profiling():
+    # Stop profiling in this process and return the records collected since start_profiling
+    global _active_profile
+    records = [] if _active_profile is None else _active_profile.records
+    _active_profile = None
+    return records
+
+
+def summarise_records(records):
+    # Totals per stage across all files
+    summary = {}
+    for record in records:
+        stage_summary = summary.setdefault(record['stage'], {'count': 0, 'wall_s': 0.0, 'rows': 0, 'bytes_read': 0,
+                                                             'bytes_written': 0, 'peak_rss_mb': 0.0})
+        stage_summary['count'] += 1
+        stage_summary['wall_s'] += record['wall_s']
+        for counter in ['rows', 'bytes_read', 'bytes_written']:
+            stage_summary[counter] += record[counter] or 0
+        stage_summary['peak_rss_mb'] = max(stage_summary['peak_rss_mb'], record['peak_rss_mb'])
+    return summary
+
+
+def write_report(records, report_path):
+    # CSV gets one row per stage per file; anything else gets JSON with the per-stage summary as well
+    if report_path.endswith('.csv'):
+        with open(report_path, 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=REPORT_FIELDS)
+            writer.writeheader()
+            writer.writerows(records)
+    else:
+        with open(report_path, 'w') as f:
+            json.dump({'summary': summarise_records(records), 'records': records}, f, indent=1)
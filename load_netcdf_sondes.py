@@ -0,0 +1,265 @@
+import collections
+import datetime as dt
+import glob
+import os
+
+import netCDF4 as nc
+import numpy as np
+import polars as pl
+
+from catalog_sondes import to_epoch_seconds
+from save_netcdf_sondes import SondeInfo, SONDE_SITE_NAMES, PRODUCT_VERSION_NUMBER, netcdf_file_path
+
+
+# Read the per-sonde NetCDF files back by station and release time, resolving paths with the same rules
+# save_netcdf_file writes them with. A SondeReader keeps an LRU cache of open datasets and one of decoded
+# variable arrays, bounded by size, so plotting the same sondes again and again doesn't reopen or re-decode
+# them. Variables are only read when indexed, and only the slice asked for:
+#
+#     with SondeReader(netcdf_dir) as reader:
+#         sonde = reader.sonde('ash-farm', '2023-06-12T11:00:00')
+#         temperature = sonde['air_temperature'][:500]
+#
+# Decoded arrays have missing values as NaN and are read-only, as they are shared between callers. A file
+# replaced by a reconversion is noticed by its mtime and reopened.
+RELEASE_TIME_FORMAT = '%Y%m%d-%H%M%S'
+
+
+def station_sonde_info(station_name):
+    # The SondeInfo for an output station name, e.g. 'larkhill'
+    for site_name in SONDE_SITE_NAMES:
+        sonde_system_info = SondeInfo(site_name)
+        if sonde_system_info.station_name == station_name:
+            return sonde_system_info
+    raise KeyError(f"Unknown station {station_name!r}")
+
+
+def to_release_datetime(value):
+    # Release times may be datetimes, ISO strings or epoch seconds; the file names are in UTC
+    return dt.datetime.fromtimestamp(to_epoch_seconds(value), dt.timezone.utc).replace(tzinfo=None)
+
+
+def sonde_path(netcdf_dir, station_name, release_time, product_version_number=PRODUCT_VERSION_NUMBER):
+    return netcdf_file_path(netcdf_dir, station_sonde_info(station_name), to_release_datetime(release_time),
+                            product_version_number)
+
+
+def find_sondes(netcdf_dir, stations=None, start=None, end=None, product_version_number=PRODUCT_VERSION_NUMBER):
+    # (station name, release datetime, path) of every per-sonde file in netcdf_dir, optionally only for some
+    # stations and release times between start and end (inclusive), in release time order. Only the day
+    # directories in range are listed.
+    start = None if start is None else to_release_datetime(start)
+    end = None if end is None else to_release_datetime(end)
+    stations = stations or sorted({SondeInfo(site_name).station_name for site_name in SONDE_SITE_NAMES})
+    sondes = []
+    for station_name in stations:
+        sonde_system_info = station_sonde_info(station_name)
+        filename_prefix = f"{sonde_system_info.instrument_name}_{station_name.lower()}_"
+        filename_suffix = f"_sonde_woest_{product_version_number}.nc"
+        for day_dir in sorted(glob.glob(os.path.join(netcdf_dir, station_name, '[0-9]' * 4, '[0-9]' * 2,
+                                                     '[0-9]' * 2))):
+            day = dt.datetime.strptime(''.join(day_dir.split(os.sep)[-3:]), '%Y%m%d')
+            if (start is not None and day.date() < start.date()) or (end is not None and day.date() > end.date()):
+                continue
+            for nc_path in sorted(glob.glob(os.path.join(day_dir, f"{filename_prefix}*{filename_suffix}"))):
+                date_string = os.path.basename(nc_path)[len(filename_prefix):-len(filename_suffix)]
+                try:
+                    release_time = dt.datetime.strptime(date_string, RELEASE_TIME_FORMAT)
+                except ValueError:
+                    continue
+                if (start is None or release_time >= start) and (end is None or release_time <= end):
+                    sondes.append((station_name, release_time, nc_path))
+    return sorted(sondes, key=lambda sonde: (sonde[1], sonde[0]))
+
+
+def normalise_key(key, shape):
+    # A hashable (start, stop, step) per dimension for basic indexing keys, or None for anything else (fancy
+    # indexing), which isn't cached
+    if not isinstance(key, tuple):
+        key = (key,)
+    if len(key) > len(shape) or any(not isinstance(item, (int, np.integer, slice)) for item in key):
+        return None
+    key = key + (slice(None),) * (len(shape) - len(key))
+    normalised = []
+    for item, length in zip(key, shape):
+        if isinstance(item, slice):
+            normalised.append(item.indices(length))
+        else:
+            index = int(item) + length if item < 0 else int(item)
+            if not 0 <= index < length:
+                raise IndexError(f"index {item} is out of bounds for length {length}")
+            normalised.append(index)
+    return tuple(normalised)
+
+
+def decode(values):
+    # Masked (fill) values to NaN for float variables, read-only since the array may be cached and shared
+    values = np.ma.filled(values, np.nan) if np.ma.isMaskedArray(values) and values.dtype.kind == 'f' \
+        else np.asarray(values)
+    values.setflags(write=False)
+    return values
+
+
+class CachedVariable:
+    # Lazy access to one variable of one sonde: nothing is read until it is indexed
+
+    def __init__(self, reader, nc_path, name):
+        self.reader = reader
+        self.nc_path = nc_path
+        self.name = name
+        variable = reader.dataset(nc_path)[name]
+        self.shape = variable.shape
+        self.dimensions = variable.dimensions
+        self.attributes = {attribute: variable.getncattr(attribute) for attribute in variable.ncattrs()}
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, key):
+        return self.reader.read(self.nc_path, self.name, key)
+
+    def __array__(self, dtype=None, copy=None):
+        values = self[:] if self.shape else self[()]
+        return values if dtype is None else values.astype(dtype)
+
+
+class CachedSonde:
+    # One per-sonde file: sonde['air_temperature'] is a CachedVariable
+
+    def __init__(self, reader, nc_path):
+        self.reader = reader
+        self.nc_path = nc_path
+
+    def __getitem__(self, name):
+        if name not in self.variables:
+            raise KeyError(name)
+        return CachedVariable(self.reader, self.nc_path, name)
+
+    @property
+    def variables(self):
+        return list(self.reader.dataset(self.nc_path).variables)
+
+    @property
+    def attributes(self):
+        dataset = self.reader.dataset(self.nc_path)
+        return {attribute: dataset.getncattr(attribute) for attribute in dataset.ncattrs()}
+
+    def to_polars(self, variables=None, start=None, stop=None):
+        # The time-dimension variables (or just `variables`) between start and stop as a DataFrame
+        dataset = self.reader.dataset(self.nc_path)
+        names = variables or [name for name, variable in dataset.variables.items()
+                              if variable.dimensions == ('time',)]
+        return pl.DataFrame({name: self.reader.read(self.nc_path, name, slice(start, stop)) for name in names})
+
+
+class SondeReader:
+
+    def __init__(self, netcdf_dir, max_open_files=32, max_cache_bytes=256 * 1024 ** 2):
+        self.netcdf_dir = netcdf_dir
+        self.max_open_files = max_open_files
+        self.max_cache_bytes = max_cache_bytes
+        # path -> (mtime_ns, Dataset), and (path, mtime_ns, variable, key) -> array, least recently used first
+        self._datasets = collections.OrderedDict()
+        self._arrays = collections.OrderedDict()
+        self._cache_bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        for _, dataset in self._datasets.values():
+            dataset.close()
+        self._datasets.clear()
+        self._arrays.clear()
+        self._cache_bytes = 0
+
+    def sonde(self, station_name, release_time):
+        nc_path = sonde_path(self.netcdf_dir, station_name, release_time)
+        if not os.path.exists(nc_path):
+            raise FileNotFoundError(f"No {station_name} sonde released at {release_time}: {nc_path}")
+        return CachedSonde(self, nc_path)
+
+    def sondes(self, stations=None, start=None, end=None):
+        return [CachedSonde(self, nc_path) for _, _, nc_path in find_sondes(self.netcdf_dir, stations, start, end)]
+
+    def _mtime_ns(self, nc_path):
+        return os.stat(nc_path).st_mtime_ns
+
+    def _forget(self, nc_path):
+        _, dataset = self._datasets.pop(nc_path)
+        dataset.close()
+        for cache_key in [cache_key for cache_key in self._arrays if cache_key[0] == nc_path]:
+            self._cache_bytes -= self._arrays.pop(cache_key).nbytes
+
+    def dataset(self, nc_path):
+        mtime_ns = self._mtime_ns(nc_path)
+        if nc_path in self._datasets:
+            if self._datasets[nc_path][0] == mtime_ns:
+                self._datasets.move_to_end(nc_path)
+                return self._datasets[nc_path][1]
+            self._forget(nc_path)
+        while len(self._datasets) >= self.max_open_files:
+            _, dataset = self._datasets.popitem(last=False)[1]
+            dataset.close()
+        dataset = nc.Dataset(nc_path)
+        self._datasets[nc_path] = (mtime_ns, dataset)
+        return dataset
+
+    def read(self, nc_path, name, key=slice(None)):
+        # The decoded slice of a variable, from the cache if it (or the whole variable) has been read before
+        variable = self.dataset(nc_path)[name]
+        mtime_ns = self._datasets[nc_path][0]
+        normalised = normalise_key(key, variable.shape)
+        if normalised is None:
+            return decode(variable[key])
+
+        whole = tuple(slice(None).indices(length) for length in variable.shape)
+        for cache_key, lookup in [((nc_path, mtime_ns, name, normalised), ...),
+                                  ((nc_path, mtime_ns, name, whole), key)]:
+            if cache_key in self._arrays:
+                self._arrays.move_to_end(cache_key)
+                self.hits += 1
+                return self._arrays[cache_key][lookup]
+
+        self.misses += 1
+        values = decode(variable[key])
+        self._store((nc_path, mtime_ns, name, normalised), values)
+        return values
+
+    def _store(self, cache_key, values):
+        if values.nbytes > self.max_cache_bytes:
+            return
+        self._arrays[cache_key] = values
+        self._cache_bytes += values.nbytes
+        while self._cache_bytes > self.max_cache_bytes:
+            self._cache_bytes -= self._arrays.popitem(last=False)[1].nbytes
+
+    def cache_info(self):
+        return {'hits': self.hits, 'misses': self.misses, 'arrays': len(self._arrays),
+                'cache_bytes': self._cache_bytes, 'max_cache_bytes': self.max_cache_bytes,
+                'open_files': len(self._datasets), 'max_open_files': self.max_open_files}
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description='List the converted radiosondes for a station and time range, '
+                                                 'or print one sonde.')
+    parser.add_argument('netcdf_dir', help='root of the NetCDF output tree')
+    parser.add_argument('--station', nargs='+', help="output station names, e.g. 'ash-farm'")
+    parser.add_argument('--start', help='earliest release time, ISO format (UTC)')
+    parser.add_argument('--end', help='latest release time, ISO format (UTC)')
+    parser.add_argument('--variables', nargs='+', help='variables to print for each sonde')
+    args = parser.parse_args()
+
+    with SondeReader(args.netcdf_dir) as reader:
+        for station_name, release_time, nc_path in find_sondes(args.netcdf_dir, args.station, args.start,
+                                                               args.end):
+            print(f"{station_name} {release_time:%Y-%m-%dT%H:%M:%S} {nc_path}")
+            if args.variables is not None:
+                print(reader.sonde(station_name, release_time).to_polars(args.variables))
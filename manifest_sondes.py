@@ -0,0 +1,112 @@
+import contextlib
+import fcntl
+import json
+import os
+
+import archive_sondes
+
+
+# The manifest lives at the top of the NetCDF output tree and records, for every raw EDT file that has been
+# converted, what the raw file looked like and which product/software version and output options (compression,
+# quantisation, derived variables) it was converted with.
+MANIFEST_FILENAME = '.woest_sondes_manifest.json'
+
+
+def manifest_path(netcdf_dir):
+    return os.path.join(netcdf_dir, MANIFEST_FILENAME)
+
+
+def load_manifest(netcdf_dir):
+    try:
+        with open(manifest_path(netcdf_dir)) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {'files': {}}
+
+
+def save_manifest(netcdf_dir, manifest):
+    # Write atomically so an interrupted run can't leave a half-written manifest behind.
+    os.makedirs(netcdf_dir, exist_ok=True)
+    tmp_path = f"{manifest_path(netcdf_dir)}.{os.getpid()}.tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.replace(tmp_path, manifest_path(netcdf_dir))
+
+
+@contextlib.contextmanager
+def manifest_lock(netcdf_dir):
+    # Held across a read-merge-write of the manifest, which a batch run and the watcher may both be doing
+    os.makedirs(netcdf_dir, exist_ok=True)
+    with open(f"{manifest_path(netcdf_dir)}.lock", 'a') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def merge_manifest(netcdf_dir, manifest, keys):
+    # Save this process's entries for keys (dropping those it no longer has) over the manifest as it is now on
+    # disk, rather than over the one it loaded, so entries another process has written since aren't lost.
+    # manifest is updated in place to the merged contents.
+    with manifest_lock(netcdf_dir):
+        merged = load_manifest(netcdf_dir)
+        for key in keys:
+            if key in manifest['files']:
+                merged['files'][key] = manifest['files'][key]
+            else:
+                merged['files'].pop(key, None)
+        save_manifest(netcdf_dir, merged)
+    manifest.clear()
+    manifest.update(merged)
+
+
+def manifest_key(raw_dir, current_edt_file):
+    # Key on the path relative to the raw directory so the raw tree can be moved or remounted.
+    return os.path.relpath(current_edt_file, raw_dir)
+
+
+def normalise_options(options):
+    # Options as they read back from the JSON manifest (tuples become lists), so they compare equal to it
+    return json.loads(json.dumps(options, sort_keys=True))
+
+
+def needs_conversion(manifest, raw_dir, current_edt_file, product_version_number, software_version_number,
+                     options=None):
+    # Entries written before options were recorded have none, so they are reconverted once
+    entry = manifest['files'].get(manifest_key(raw_dir, current_edt_file))
+    if entry is None:
+        return True
+    if (entry['product_version_number'] != product_version_number
+            or entry['software_version_number'] != software_version_number
+            or entry.get('options') != normalise_options(options or {})):
+        return True
+    if entry['output'] is None or not os.path.exists(entry['output']):
+        return True
+
+    # Size and mtime are enough to skip unchanged files without reading them. Only hash when the mtime has
+    # moved but the size hasn't (e.g. a file re-copied with identical content, or an archive rewritten with
+    # other members changed). Archive members use their own size and the archive's mtime.
+    size, mtime_ns = archive_sondes.source_size_mtime(current_edt_file)
+    if size != entry['size']:
+        return True
+    if mtime_ns == entry['mtime_ns']:
+        return False
+    if archive_sondes.source_sha256(current_edt_file) != entry['sha256']:
+        return True
+    entry['mtime_ns'] = mtime_ns
+    return False
+
+
+def record_conversion(manifest, raw_dir, current_edt_file, output, product_version_number,
+                      software_version_number, options=None):
+    size, mtime_ns = archive_sondes.source_size_mtime(current_edt_file)
+    manifest['files'][manifest_key(raw_dir, current_edt_file)] = {
+        'sha256': archive_sondes.source_sha256(current_edt_file),
+        'size': size,
+        'mtime_ns': mtime_ns,
+        'output': os.path.abspath(output),
+        'product_version_number': product_version_number,
+        'software_version_number': software_version_number,
+        'options': normalise_options(options or {}),
+    }
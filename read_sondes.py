@@ -2,47 +2,155 @@
 
 import polars as pl
 import datetime as dt
+import glob
 import os
+import tarfile
+import zipfile
+import archive_sondes
+import instrument_sondes
 
 
-def do_radiosondes(file_name, outdir):
+# stations = ['Ash_Farm', 'Castle_Cary', 'Chilbolton', 'Larkhill', 'Netheravon', 'Reading', 'Spire_View']
+STATIONS = ['Ash_Farm', 'Chilbolton', 'Larkhill', 'Reading', 'Spire_View']  # edited list
+EDT_FILE_SEARCH = 'edt1sdataforv217*.txt'
+
+
+# Types the EDT columns are parsed as when do_radiosondes is asked for a projection of columns. This covers
+# everything save_netcdf_file (and the CSV export below) uses; any other requested column is read as a string.
+SONDE_COLUMN_TYPES = {
+    "Elapsed time": pl.Float32,
+    "TimeUTC": pl.String,
+    "HeightMSL": pl.Float32,
+    "GpsHeightMSL": pl.Float32,
+    "RH": pl.Float32,
+    # Kept as Float64: geospatial_bounds is written to 6 decimal places, beyond float32 precision
+    "Lat": pl.Float64,
+    "Lon": pl.Float64,
+    "P": pl.Float32,
+    "Temp": pl.Float32,
+    "Dir": pl.Float32,
+    "Speed": pl.Float32,
+    "AscRate": pl.Float32,
+}
+
+# Vaisala writes missing values as a run of slashes filling the field, e.g. '//////'
+MISSING_VALUE_MARKERS = ["/" * width for width in range(1, 16)]
+
+
+def split_edt_buffer(edt_bytes, radiosonde_metadata):
+    # Walk the metadata block at the top of an EDT file, collecting "key<TAB>value" lines into
+    # radiosonde_metadata, up to the column header and units lines. Returns the cleaned column names, the units
+    # and the remaining tab-separated data block, still as bytes.
+    position = 0
+    column_names = None
+    while True:
+        line_end = edt_bytes.find(b"\n", position)
+        if line_end == -1:
+            raise ValueError("EDT file ended before the data column header and units lines")
+        data = edt_bytes[position:line_end].decode("charmap")
+        position = line_end + 1
+        if column_names is not None:
+            data_units = [i.strip() for i in data.split("\t")]
+            break
+        elif data.startswith("Elapsed time") or data.startswith(" TimeUTC"):
+            column_names = [i.strip() for i in data.split("\t")]
+        elif "\t" in data:
+            data_key = data.split("\t")[0].strip()
+            data_value = data.split("\t")[1].strip()
+            radiosonde_metadata[data_key] = data_value
+
+    return column_names, data_units, edt_bytes[position:]
+
+
+def edt_release_time(file_name):
+    # Release time from an EDT file name, edt1sdataforv217_YYYYmmdd_HHMMSS.txt, without opening the file
+    _, date_string, time_string = archive_sondes.edt_base_name(file_name).split(".")[0].split("_")[:3]
+    return dt.datetime.strptime(date_string + time_string, "%Y%m%d%H%M%S")
+
+
+def find_edt_files(raw_dir, stations=None, start=None, end=None, skip_unreadable_archives=False):
+    # EDT files under raw_dir/<station>, for all of STATIONS or just `stations`, optionally only those whose
+    # file name puts them between the start and end datetimes (inclusive). As well as plain files this finds
+    # gzipped ones and the members of zip/tar bundles, either in the station directory or next to it named
+    # after the station (raw_dir/Ash_Farm.tar.gz), as archive_sondes source names. Archive members are listed
+    # in archive order, which is the cheap order to read them in.
+    edt_file_list = []
+    for station in stations or STATIONS:
+        current_search = os.path.join(raw_dir, station, EDT_FILE_SEARCH)
+        edt_file_list.extend(sorted(glob.glob(current_search)))
+        edt_file_list.extend(sorted(glob.glob(current_search + ".gz")))
+        archive_paths = (sorted(glob.glob(os.path.join(raw_dir, station, "*")))
+                         + sorted(glob.glob(os.path.join(raw_dir, station + ".*"))))
+        for archive_path in archive_paths:
+            if not archive_sondes.is_archive(archive_path):
+                continue
+            try:
+                edt_file_list.extend(archive_sondes.list_archive_members(archive_path, EDT_FILE_SEARCH))
+            except (OSError, EOFError, zipfile.BadZipFile, tarfile.TarError):
+                # e.g. an archive that is still being copied in
+                if not skip_unreadable_archives:
+                    raise
+    if start is not None or end is not None:
+        edt_file_list = [current_edt_file for current_edt_file in edt_file_list
+                         if (start is None or edt_release_time(current_edt_file) >= start)
+                         and (end is None or edt_release_time(current_edt_file) <= end)]
+    return edt_file_list
+
+
+def scan_edt_data(data_bytes, column_names, columns):
+    # Lazily scan the data block of an EDT file: only `columns` (those that exist in the file) are parsed,
+    # straight to SONDE_COLUMN_TYPES, with missing values as null. Every column needs a type in the schema, but
+    # columns that aren't projected are never parsed, so the others can be left as strings at no cost.
+    return (
+        pl.scan_csv(
+            data_bytes,
+            has_header=False,
+            separator="\t",
+            schema={name: SONDE_COLUMN_TYPES.get(name, pl.String) for name in column_names},
+            null_values=MISSING_VALUE_MARKERS,
+        )
+        .select([name for name in columns if name in column_names])
+        # Remove empty lines in csv file
+        .filter(pl.col("TimeUTC").is_not_null())
+    )
+
+
+def do_radiosondes(file_name, outdir, columns=None):
+    # With columns=None every column is read with inferred types, missing values as NaN. Given a list of
+    # columns, only those (that exist in the file) are scanned, parsed straight to SONDE_COLUMN_TYPES, with
+    # missing values as null.
     radiosonde_metadata = {}
-    radiosonde_metadata["date"] = file_name.split("/")[-1].split("_")[1]
-    radiosonde_metadata["time"] = file_name.split("/")[-1].split("_")[2].split(".")[0]
-
-    with open(file_name, encoding="charmap") as f:
-        line_skip = 0
-        units_line_next = False
-        while True:
-            data = f.readline()
-            if units_line_next:
-                data_units = [i.strip() for i in data.split("\t")]
-                break
-            elif data.startswith("Elapsed time") or data.startswith(" TimeUTC"):
-                units_line_next = True
-            elif "\t" in data and not units_line_next:
-                data_key = data.split("\t")[0].strip()
-                data_value = data.split("\t")[1].strip()
-                radiosonde_metadata[data_key] = data_value
-                line_skip += 1
-            else:
-                line_skip += 1
-
-    df = pl.read_csv(
-        file_name,
-        encoding="charmap",
-        skip_rows=line_skip,
-        separator="\t",
-        skip_rows_after_header=1,
-        ignore_errors=True,
-    ).fill_null(float("nan"))
-
-    for column_name in df.columns:
-        df = df.rename({column_name: column_name.strip()})
-
-    # Remove empty lines in csv file
-    df = df.filter(pl.col("TimeUTC") != '')
+    radiosonde_metadata["date"] = archive_sondes.edt_base_name(file_name).split("_")[1]
+    radiosonde_metadata["time"] = archive_sondes.edt_base_name(file_name).split("_")[2].split(".")[0]
+
+    # Read the file once (decompressing it if it is gzipped or in an archive) and parse both the header and the
+    # data from the same in-memory buffer
+    with instrument_sondes.stage("read_file") as record:
+        edt_bytes = archive_sondes.read_edt_source(file_name)
+        record["bytes_read"] = len(edt_bytes)
+    with instrument_sondes.stage("parse_header"):
+        column_names, data_units, data_bytes = split_edt_buffer(edt_bytes, radiosonde_metadata)
+
+    # The data block is almost always plain ASCII and can go straight to polars. Only re-encode it (the files
+    # are charmap encoded, polars wants UTF-8) when it isn't.
+    if not data_bytes.isascii():
+        data_bytes = data_bytes.decode("charmap").encode("utf8")
+
+    with instrument_sondes.stage("read_csv") as record:
+        if columns is None:
+            df = pl.read_csv(
+                data_bytes,
+                has_header=False,
+                new_columns=column_names,
+                separator="\t",
+                ignore_errors=True,
+            ).fill_null(float("nan"))
 
+            # Remove empty lines in csv file
+            df = df.filter(pl.col("TimeUTC") != '')
+        else:
+            df = scan_edt_data(data_bytes, column_names, columns).collect()
+        record["rows"] = len(df)
 
     df_small = df.select(
         [
@@ -97,6 +205,62 @@ def do_radiosondes(file_name, outdir):
     return df, radiosonde_metadata, data_units
 
 
+def read_many(file_names=None, raw_dir=None, stations=None, start=None, end=None, columns=None, lazy=False):
+    # Load many EDT files, given as a list of file_names or as a raw_dir filtered by station directory and
+    # release time (see find_edt_files), into one frame with a sonde_id and station column, plus a metadata
+    # table with one row per sonde keyed by the same sonde_id.
+    #
+    # Only the headers are parsed here, one file at a time. The data blocks become lazy scans that are
+    # concatenated and collected together, so polars parses every file in parallel on its own thread pool.
+    # With lazy=True the data comes back as a LazyFrame, for further filtering before anything is parsed.
+    # sonde_id ('<Station name>_YYYYmmdd-HHMMSS') and station are Enums over the sondes and stations loaded.
+    # The same sonde can be found more than once (a plain file next to its .gz, or a loose copy of an archive
+    # member); only the first file for each sonde_id is loaded, which for find_edt_files is the plain file.
+    if file_names is None:
+        file_names = find_edt_files(raw_dir, stations, start, end)
+    columns = columns or list(SONDE_COLUMN_TYPES)
+
+    scans = []
+    metadata_rows = []
+    loaded = set()
+    for file_name in file_names:
+        radiosonde_metadata = {}
+        edt_bytes = archive_sondes.read_edt_source(file_name)
+        try:
+            column_names, data_units, data_bytes = split_edt_buffer(edt_bytes, radiosonde_metadata)
+        except ValueError as error:
+            raise ValueError(f"{file_name}: {error}") from None
+        if not data_bytes.isascii():
+            data_bytes = data_bytes.decode("charmap").encode("utf8")
+        start_time_dt = dt.datetime.strptime(radiosonde_metadata["Balloon release date and time"],
+                                             "%Y-%m-%dT%H:%M:%S")
+        sonde_id = f"{radiosonde_metadata['Station name']}_{start_time_dt:%Y%m%d-%H%M%S}"
+        if sonde_id in loaded:
+            continue
+        loaded.add(sonde_id)
+        scans.append((sonde_id, radiosonde_metadata["Station name"], scan_edt_data(data_bytes, column_names, columns)))
+        metadata_rows.append({"sonde_id": sonde_id, "station": radiosonde_metadata["Station name"],
+                              "file": file_name, "start_time_dt": start_time_dt, **radiosonde_metadata,
+                              "units": dict(zip(column_names, data_units))})
+
+    sonde_ids = pl.Enum([sonde_id for sonde_id, _, _ in scans])
+    station_names = pl.Enum(sorted({station for _, station, _ in scans}))
+    lf = pl.concat(
+        [scan.with_columns(pl.lit(sonde_id, dtype=sonde_ids).alias("sonde_id"),
+                           pl.lit(station, dtype=station_names).alias("station"))
+         for sonde_id, station, scan in scans],
+        how="diagonal_relaxed",
+    ) if scans else pl.LazyFrame(schema={"sonde_id": sonde_ids, "station": station_names})
+    lf = lf.select("sonde_id", "station", pl.exclude("sonde_id", "station"))
+
+    # Header fields missing from some files are null; units are a struct of column -> unit
+    metadata = pl.DataFrame(metadata_rows, infer_schema_length=None).with_columns(
+        pl.col("sonde_id").cast(sonde_ids), pl.col("station").cast(station_names)
+    ) if metadata_rows else pl.DataFrame(schema={"sonde_id": sonde_ids, "station": station_names})
+
+    return (lf if lazy else lf.collect()), metadata
+
+
 if __name__ == "__main__":
     import sys
 
@@ -0,0 +1,283 @@
+import datetime as dt
+import os
+
+import numpy as np
+
+import derive_sondes
+from derive_sondes import pack_profiles
+import save_netcdf_sondes
+from save_netcdf_sondes import (SondeInfo, NetcdfCompression, atomic_netcdf_dataset, create_string_variable,
+                                epoch_to_datetime, set_project_attributes, EPOCH)
+
+
+# Regrid many sondes at once from their native 1 s samples onto common vertical levels, giving a compact
+# (sonde, level) cube per station or for the whole campaign. The vertical coordinate is either pressure (standard
+# levels, interpolated linearly in ln p) or altitude (fixed height levels, linear in height). Instead of
+# interpolating, each level can be the mean of the samples in the bin around it, with bin edges halfway between
+# levels in the same coordinate.
+#
+# Every variable of the batch is packed into NaN-padded (sonde, sample) arrays from its own valid samples, so one
+# vectorised interpolation or bincount handles all the sondes together. Wind is regridded as u/v components,
+# then turned back into speed and direction. Levels outside a sonde's ascent are NaN; nothing is extrapolated.
+
+STANDARD_PRESSURE_LEVELS = [1000, 925, 850, 700, 500, 400, 300, 250, 200, 150, 100, 70, 50, 30, 20, 10]
+
+# Vertical coordinate -> (NetCDF variable, column)
+VERTICAL_COORDINATES = {
+    'pressure': ('air_pressure', 'P'),
+    'height': ('altitude', 'GpsHeightMSL'),
+}
+
+# Cube variable -> (column, units, standard_name, long_name). The vertical coordinate is dropped from these.
+REGRID_VARIABLES = {
+    'time': ('EpochTime', 'seconds since 1970-01-01 00:00:00', 'time', 'Time (seconds since 1970-01-01 00:00:00)'),
+    'altitude': ('GpsHeightMSL', 'm', 'altitude', 'Geometric height above geoid (WGS 84).'),
+    'latitude': ('Lat', 'degrees_north', 'latitude', 'Latitude'),
+    'longitude': ('Lon', 'degrees_east', 'longitude', 'Longitude'),
+    'air_pressure': ('P', 'hPa', 'air_pressure', 'Air Pressure'),
+    'air_temperature': ('TempK', 'K', 'air_temperature', 'AirTemperature'),
+    'relative_humidity': ('RH', '%', 'relative_humidity', 'Relative Humidity'),
+    'eastward_wind': ('U', 'm s-1', 'eastward_wind', 'Eastward Wind Component'),
+    'northward_wind': ('V', 'm s-1', 'northward_wind', 'Northward Wind Component'),
+    'wind_speed': (None, 'm s-1', 'wind_speed', 'Wind Speed'),
+    'wind_from_direction': (None, 'degree', 'wind_from_direction', 'Wind From Direction'),
+    'upward_balloon_velocity': ('AscRate', 'm s-1', '', 'Balloon Ascent Rate'),
+    'elapsed_time': ('Elapsed time', 's', '', 'Elapsed Time'),
+}
+
+
+def vertical_axis(values, vertical):
+    # Map pressures or heights to a coordinate that increases with height and is linear for interpolation
+    values = np.asarray(values, dtype=np.float64)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return -np.log(values) if vertical == 'pressure' else values
+
+
+def level_edges(axis_levels):
+    # Bin edges halfway between levels (on the vertical axis), the outer ones as far out as the inner spacing
+    axis_levels = np.sort(axis_levels)
+    midpoints = (axis_levels[1:] + axis_levels[:-1]) / 2
+    first = axis_levels[0] - (midpoints[0] - axis_levels[0]) if len(axis_levels) > 1 else axis_levels[0] - 0.5
+    last = axis_levels[-1] + (axis_levels[-1] - midpoints[-1]) if len(axis_levels) > 1 else axis_levels[-1] + 0.5
+    return np.concatenate(([first], midpoints, [last]))
+
+
+def ascending_axis(axis_values):
+    # Cut each sonde at the top of its ascent and make the axis non-decreasing (a running maximum absorbs sensor
+    # noise). Padding after the last valid sample takes the row's maximum, so every row stays sorted.
+    with np.errstate(invalid='ignore'):
+        ascent_end = np.argmax(np.where(np.isnan(axis_values), -np.inf, axis_values), axis=1)
+    after_ascent = np.arange(axis_values.shape[1]) > ascent_end[:, None]
+    axis_values = np.fmax.accumulate(np.where(after_ascent, np.nan, axis_values), axis=1)
+    return axis_values, after_ascent
+
+
+def interpolate_batch(axis_values, values, axis_levels):
+    # Linearly interpolate every row of values (sonde, sample) from its axis_values onto axis_levels, using a
+    # single searchsorted over the whole batch: each row's axis is shifted into its own non-overlapping range.
+    n_sondes, n_samples = axis_values.shape
+    axis_values, after_ascent = ascending_axis(axis_values)
+    values = np.where(after_ascent, np.nan, values)
+    row_min = np.nanmin(np.where(np.isnan(axis_values), np.inf, axis_values), axis=1)
+    row_max = np.nanmax(np.where(np.isnan(axis_values), -np.inf, axis_values), axis=1)
+    finite = np.isfinite(row_min) & np.isfinite(row_max)
+    span = np.max(np.where(finite, row_max - row_min, 0), initial=0) + max(1.0, np.ptp(axis_levels))
+    row_start = np.arange(n_sondes)[:, None] * 2 * span
+    shift = np.where(finite[:, None], row_start - row_min[:, None], row_start)
+
+    # Sondes with no valid samples at all are parked at the start of their range to keep the batch sorted
+    shifted_axis = np.where(np.isnan(axis_values), row_start, axis_values + shift)
+    shifted_levels = np.asarray(axis_levels)[None, :] + shift
+    position = np.searchsorted(shifted_axis.ravel(), shifted_levels.ravel(), side='right').reshape(shifted_levels.shape)
+    rows = np.arange(n_sondes)[:, None]
+    lower = np.clip(position - rows * n_samples - 1, 0, max(n_samples - 2, 0))
+    upper = np.minimum(lower + 1, n_samples - 1)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        x0 = axis_values[rows, lower]
+        x1 = axis_values[rows, upper]
+        weight = np.where(x1 > x0, (np.asarray(axis_levels)[None, :] - x0) / (x1 - x0), 0.0)
+        result = values[rows, lower] + weight * (values[rows, upper] - values[rows, lower])
+    inside = finite[:, None] & (axis_levels >= row_min[:, None]) & (axis_levels <= row_max[:, None])
+    return np.where(inside, result, np.nan)
+
+
+def bin_average_batch(axis_values, values, axis_levels):
+    # Mean of the samples of every row falling in each level's bin, with one bincount over the whole batch
+    n_sondes = axis_values.shape[0]
+    n_levels = len(axis_levels)
+    axis_values, after_ascent = ascending_axis(axis_values)
+    order = np.argsort(axis_levels)
+    bins = np.digitize(axis_values, level_edges(axis_levels)) - 1
+    valid = ~after_ascent & ~np.isnan(values) & (bins >= 0) & (bins < n_levels)
+    # bins index the sorted levels; map them back to the order the levels were given in
+    keys = (np.arange(n_sondes)[:, None] * n_levels + order[np.clip(bins, 0, n_levels - 1)])[valid]
+    sums = np.bincount(keys, weights=values[valid], minlength=n_sondes * n_levels)
+    counts = np.bincount(keys, minlength=n_sondes * n_levels)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return (sums / counts).reshape(n_sondes, n_levels)
+
+
+def regrid_batch(dfs, levels, vertical='pressure', method='interpolate'):
+    # Regrid prepared sondes (after prepare_sonde_columns) onto levels (hPa or m). Returns a dict of
+    # (sonde, level) arrays, keyed by REGRID_VARIABLES name, without the vertical coordinate itself.
+    coordinate_variable, coordinate_column = VERTICAL_COORDINATES[vertical]
+    regrid = interpolate_batch if method == 'interpolate' else bin_average_batch
+    axis_levels = vertical_axis(levels, vertical)
+    dfs = [df.with_columns(derive_sondes.wind_component_expressions()) for df in dfs]
+
+    cube = {}
+    for variable_name, (column, _, _, _) in REGRID_VARIABLES.items():
+        if variable_name == coordinate_variable or column is None:
+            continue
+        packed, _ = pack_profiles(dfs, [coordinate_column, column])
+        cube[variable_name] = regrid(vertical_axis(packed[coordinate_column], vertical), packed[column], axis_levels)
+    cube['wind_speed'] = np.hypot(cube['eastward_wind'], cube['northward_wind'])
+    cube['wind_from_direction'] = np.degrees(np.arctan2(-cube['eastward_wind'], -cube['northward_wind'])) % 360
+    return cube
+
+
+def save_regridded_netcdf_file(sondes, nc_path, levels, vertical='pressure', method='interpolate',
+                               compression=None):
+    # Write an orthogonal multidimensional profile file (featureType profile): dimensions (sonde, level) with
+    # the levels as a coordinate variable. sondes is a list of (df, radiosonde_metadata, current_edt_filename).
+    this_fill_value = -1.00e+20
+    compression = compression or NetcdfCompression()
+    coordinate_variable, _ = VERTICAL_COORDINATES[vertical]
+
+    sondes = sorted(sondes, key=lambda sonde: sonde[1]['start_time_dt'])
+    cube = regrid_batch([sonde_df for sonde_df, _, _ in sondes], levels, vertical, method)
+    sonde_system_infos = [SondeInfo(radiosonde_metadata['Station name']) for _, radiosonde_metadata, _ in sondes]
+    station_names = sorted({sonde_system_info.station_name for sonde_system_info in sonde_system_infos})
+    release_times = np.array([(radiosonde_metadata['start_time_dt'] - EPOCH).total_seconds()
+                              for _, radiosonde_metadata, _ in sondes])
+
+    current_time = dt.datetime.now(dt.timezone.utc)
+    current_time_string = current_time.strftime('%Y-%m-%dT%H:%M:%S')
+
+    os.makedirs(os.path.dirname(nc_path) or '.', exist_ok=True)
+    print(nc_path)
+
+    with atomic_netcdf_dataset(nc_path, format='NETCDF4_CLASSIC') as dataset_out:
+        dataset_out.createDimension('sonde', len(sondes))
+        dataset_out.createDimension(coordinate_variable, len(levels))
+
+        # Global attributes
+        dataset_out.Conventions = 'CF-1.6'
+        dataset_out.source = 'Vaisala radiosonde sounding systems'
+        dataset_out.instrument_manufacturer = 'Vaisala'
+        set_project_attributes(dataset_out, current_time_string)
+        dataset_out.acknowledgement = "".join([
+            'Acknowledgement of ',
+            ', '.join(sorted({sonde_system_info.data_provider for sonde_system_info in sonde_system_infos})),
+            ' as the data provider is required whenever and wherever these data are used'])
+        dataset_out.platform = ', '.join(station_names)
+        dataset_out.title = f"Radiosonde ascents on common {'pressure' if vertical == 'pressure' else 'height'} levels"
+        dataset_out.featureType = 'profile'
+        dataset_out.time_coverage_start = epoch_to_datetime(release_times.min()).strftime('%Y-%m-%dT%H:%M:%S')
+        dataset_out.time_coverage_end = epoch_to_datetime(np.nanmax(cube['time'])
+                                                          if np.isfinite(cube['time']).any()
+                                                          else release_times.max()).strftime('%Y-%m-%dT%H:%M:%S')
+        dataset_out.location_keywords = ', '.join(station_names)
+        regrid_method = ('linear interpolation in ln(pressure)' if vertical == 'pressure'
+                         else 'linear interpolation in height') if method == 'interpolate' else 'bin mean'
+        dataset_out.comment = (f"{len(sondes)} radiosonde ascents regridded from their native 1 s samples by "
+                               f"{regrid_method}. Levels outside an ascent are missing.")
+
+        # Vertical coordinate
+        _, units, standard_name, long_name = REGRID_VARIABLES[coordinate_variable]
+        coordinates = dataset_out.createVariable(coordinate_variable, np.float32, (coordinate_variable,))
+        coordinates.units = units
+        coordinates.standard_name = standard_name
+        coordinates.long_name = long_name
+        coordinates.axis = 'Z'
+        coordinates.positive = 'down' if vertical == 'pressure' else 'up'
+        coordinates[:] = np.asarray(levels, dtype=np.float32)
+
+        # Per-sonde variables
+        sonde_ids = create_string_variable(
+            dataset_out, 'sonde_id', 'sonde',
+            [f"{sonde_system_info.station_name}_{radiosonde_metadata['start_time_dt']:%Y%m%d-%H%M%S}"
+             for sonde_system_info, (_, radiosonde_metadata, _) in zip(sonde_system_infos, sondes)])
+        sonde_ids.cf_role = 'profile_id'
+        sonde_ids.long_name = 'Radiosonde ascent identifier'
+        release_time = dataset_out.createVariable('release_time', np.double, ('sonde',))
+        release_time.units = 'seconds since 1970-01-01 00:00:00'
+        release_time.standard_name = 'time'
+        release_time.long_name = 'Balloon release time'
+        release_time.calendar = 'standard'
+        release_time[:] = release_times
+        platforms = create_string_variable(dataset_out, 'platform', 'sonde',
+                                           [sonde_system_info.station_name for sonde_system_info in sonde_system_infos])
+        platforms.long_name = 'Launch station'
+        raw_files = create_string_variable(dataset_out, 'raw_data_file', 'sonde',
+                                           [current_edt_filename for _, _, current_edt_filename in sondes])
+        raw_files.long_name = 'Original raw data'
+
+        # (sonde, level) variables
+        for variable_name, values in cube.items():
+            _, units, standard_name, long_name = REGRID_VARIABLES[variable_name]
+            kwargs = compression.variable_kwargs(variable_name, len(levels))
+            kwargs.pop('chunksizes', None)
+            regridded = dataset_out.createVariable(variable_name, np.double if variable_name == 'time' else np.float32,
+                                                   ('sonde', coordinate_variable), fill_value=this_fill_value,
+                                                   **kwargs)
+            regridded.units = units
+            regridded.standard_name = standard_name
+            regridded.long_name = long_name
+            if variable_name == 'time':
+                regridded.calendar = 'standard'
+            else:
+                regridded.coordinates = 'release_time latitude longitude'
+                regridded.cell_methods = (f"{coordinate_variable}: mean" if method == 'bin'
+                                          else f"{coordinate_variable}: point")
+            regridded[:] = np.where(np.isnan(values), this_fill_value, values)
+
+    return nc_path
+
+
+def regrid_sondes_to_netcdf(raw_dir, netcdf_dir, levels, vertical='pressure', method='interpolate',
+                            aggregate='station', workers=1, compression=None):
+    # One cube per station (aggregate='station') or for the whole campaign (aggregate='campaign')
+    summary = save_netcdf_sondes.run_sonde_jobs(save_netcdf_sondes.read_prepared_sonde,
+                                                save_netcdf_sondes.find_edt_files(raw_dir), workers, netcdf_dir)
+
+    for station_name, sondes in save_netcdf_sondes.group_prepared_sondes(summary, aggregate).items():
+        nc_path = save_netcdf_sondes.aggregate_netcdf_path(netcdf_dir, station_name, sondes, f"{vertical}-levels")
+        save_regridded_netcdf_file(sondes, nc_path, levels, vertical, method, compression)
+
+    for result in summary:
+        result.pop('sonde')
+    save_netcdf_sondes.print_conversion_summary(summary)
+    return summary
+
+
+if __name__ == "__main__":
+    import argparse
+    import sys
+
+    parser = argparse.ArgumentParser(description='Regrid WOEST radiosondes onto common pressure or height levels.')
+    parser.add_argument('raw_dir', help='directory containing one sub-directory of EDT files per station')
+    parser.add_argument('netcdf_dir', help='root directory for the NetCDF output tree')
+    parser.add_argument('--vertical', choices=list(VERTICAL_COORDINATES), default='pressure',
+                        help='regrid onto pressure levels (hPa) or height levels (m above sea level)')
+    parser.add_argument('--levels', type=float, nargs='+',
+                        help='levels to regrid onto (default: standard pressure levels, or every 100 m up to '
+                             '--top for height)')
+    parser.add_argument('--top', type=float, default=20000, help='top of the default height levels (default: 20000 m)')
+    parser.add_argument('--method', choices=['interpolate', 'bin'], default='interpolate',
+                        help='linear interpolation, or the mean of the samples in the bin around each level')
+    parser.add_argument('--aggregate', choices=['station', 'campaign'], default='station',
+                        help='one cube per station (default) or one for the whole campaign')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='number of worker processes to read files with (default: 1, no pool)')
+    parser.add_argument('--compression', choices=sorted(save_netcdf_sondes.COMPRESSION_PROFILES), default='default')
+    args = parser.parse_args()
+
+    levels = args.levels
+    if levels is None:
+        levels = STANDARD_PRESSURE_LEVELS if args.vertical == 'pressure' else list(np.arange(0, args.top + 1, 100.0))
+    summary = regrid_sondes_to_netcdf(args.raw_dir, args.netcdf_dir, levels, vertical=args.vertical,
+                                      method=args.method, aggregate=args.aggregate, workers=args.workers,
+                                      compression=NetcdfCompression(args.compression))
+    sys.exit(1 if any(result['error'] is not None for result in summary) else 0)
@@ -1,10 +1,41 @@
-from read_sondes import do_radiosondes
-import glob
+from read_sondes import do_radiosondes, find_edt_files, SONDE_COLUMN_TYPES
+import archive_sondes
+import catalog_sondes
+import derive_sondes
+import index_sondes
+import instrument_sondes
+import manifest_sondes
 import netCDF4 as nc
 import datetime as dt
 import numpy as np
 import polars as pl
+import contextlib
+import multiprocessing
 import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+
+EPOCH = dt.datetime(1970, 1, 1, 0, 0, 0)
+SECONDS_PER_DAY = 86400
+
+# NetCDF data variables and the EDT (or derived) columns they are written from
+VARIABLE_COLUMNS = {
+    'altitude': 'GpsHeightMSL',
+    'latitude': 'Lat',
+    'longitude': 'Lon',
+    'air_pressure': 'P',
+    'air_temperature': 'TempK',
+    'relative_humidity': 'RH',
+    'wind_speed': 'Speed',
+    'wind_from_direction': 'Dir',
+    'upward_balloon_velocity': 'AscRate',
+    'elapsed_time': 'Elapsed time',
+}
+
+# Bumping either of these makes an incremental run reconvert every file.
+PRODUCT_VERSION_NUMBER = 'v1.1'
+SOFTWARE_VERSION_NUMBER = 'v1.0'
 
 
 # Class with all the sonde information in.
@@ -58,86 +89,193 @@ class SondeInfo:
             self.data_provider = 'Met Office and NCAS'
 
 
-def save_netcdf_file(df, radiosonde_metadata, netcdf_dir, current_edt_filename):
-    # Replace nulls with NaNs
-    this_fill_value = -1.00e+20
+# Every 'Station name' an EDT header can have, i.e. every site SondeInfo knows about
+SONDE_SITE_NAMES = ['AshFarm', 'Chilbolton', 'LAR_A', 'Larkhill_B', 'Reading', 'SpireView']
 
-    # Convert time string to datetime
-    start_date = f"{radiosonde_metadata['start_time_dt']:%Y-%m-%d}"
-    sonde_time_dt = []
 
-    for this_time in df["TimeUTC"]:
-        sonde_time_dt.append(dt.datetime.strptime(f"{start_date}T{this_time}", "%Y-%m-%dT%H:%M:%S"))
-
-    # Load sonde system metadata
-    sonde_system_info = SondeInfo(radiosonde_metadata['Station name'])
-    # Set up file name
+def netcdf_file_path(netcdf_dir, sonde_system_info, start_time_dt, product_version_number=PRODUCT_VERSION_NUMBER):
+    # Where the per-sonde file for a release goes: <station>/<YYYY>/<MM>/<DD>/ under netcdf_dir
     # use format: radiosonde_woest_ashfarm_20231010_112200_v1
-    date_string = radiosonde_metadata['start_time_dt'].strftime("%Y%m%d-%H%M%S")
-    product_version_number = 'v1.1'
-    software_version_number = 'v1.0'
+    date_string = start_time_dt.strftime("%Y%m%d-%H%M%S")
     nc_filename = (f"{sonde_system_info.instrument_name}_{sonde_system_info.station_name.lower()}_{date_string}_"
                    f"sonde_woest_{product_version_number}.nc")
-    current_time = dt.datetime.now(dt.timezone.utc)
-    current_time_string = current_time.strftime('%Y-%m-%dT%H:%M:%S') # %z: removed time zone
-    lat_lon_string = (
-            f'{min(df["Lat"][:]):0.6f}' + 'N ' # ('N' if min(df["Lat"][:]) >= 0 else 'S') + ' '
-            + f'{min(df["Lon"][:]):0.6f}' + 'E, ' # ('E' if min(df["Lon"][:]) >= 0 else 'W')) + ', '
-            + f'{max(df["Lat"][:]):0.6f}' + 'N ' # ('N' if max(df["Lat"][:]) >= 0 else 'S') + ' '
-            + f'{max(df["Lon"][:]):0.6f}' + 'E' # ('E' if max(df["Lon"][:]) >= 0 else 'W')
-            )
-    sampling_interval = int((sonde_time_dt[1]-sonde_time_dt[0]).seconds)
+    return os.path.join(netcdf_dir, sonde_system_info.station_name, start_time_dt.strftime("%Y"),
+                        start_time_dt.strftime("%m"), start_time_dt.strftime("%d"), nc_filename)
 
-    # Create NetCDF directories
-    save_netcdf_dir = os.path.join(netcdf_dir, sonde_system_info.station_name, radiosonde_metadata['start_time_dt'].strftime("%Y"), radiosonde_metadata['start_time_dt'].strftime("%m"), radiosonde_metadata['start_time_dt'].strftime("%d"))
-    os.makedirs(save_netcdf_dir, exist_ok=True)
 
-    # Open NetCDF file
-    dataset_out = nc.Dataset(os.path.join(save_netcdf_dir,nc_filename), 'w', format='NETCDF4_CLASSIC')
-    print(os.path.join(save_netcdf_dir,nc_filename))
+# NetCDF storage settings. The profiles are createVariable keyword arguments applied to every variable;
+# quantisation keeps least_significant_digit decimal places per variable, chosen to match the sensor precision,
+# which makes the float32 columns compress much better under shuffle+deflate.
+COMPRESSION_PROFILES = {
+    'none': {},
+    'default': {'zlib': True, 'complevel': 4, 'shuffle': True},
+    'archive': {'zlib': True, 'complevel': 9, 'shuffle': True},
+}
+LEAST_SIGNIFICANT_DIGITS = {
+    'altitude': 1,  # 0.1 m
+    'latitude': 5,  # ~1 m
+    'longitude': 5,
+    'air_pressure': 2,  # 0.01 hPa
+    'air_temperature': 2,  # 0.01 K
+    'relative_humidity': 1,  # 0.1 %RH
+    'wind_speed': 2,  # 0.01 m s-1
+    'wind_from_direction': 1,  # 0.1 degree
+    'upward_balloon_velocity': 2,  # 0.01 m s-1
+    'elapsed_time': 1,  # 0.1 s
+    'dew_point_temperature': 2,
+    'air_potential_temperature': 2,
+    'equivalent_potential_temperature': 2,
+    'humidity_mixing_ratio': 6,  # 0.001 g kg-1
+    'eastward_wind': 2,
+    'northward_wind': 2,
+}
 
-    # Set up dimensions
-    time_dim = dataset_out.createDimension('time', len(sonde_time_dt))
 
-    # Make sure units are right
-    temp_k = pl.Series([float(i) + 273.15 for i in list(df["Temp"])])
-    df = df.with_columns(temp_k.alias("TempK"))
+class NetcdfCompression:
 
-    # Reading is missing elapsed time, so it's recreated here.
-    if sonde_system_info.station_name == 'reading':
-        elapsed_time = pl.Series(float((i - sonde_time_dt[0]).seconds) for i in list(sonde_time_dt))
-        df = df.with_columns(elapsed_time.alias("Elapsed time"))
-
-    # Set source
-    if sonde_system_info.station_name == 'ash-farm':
-        data_source = 'NCAS Vaisala Sounding Station unit 1'
-        conventions = 'CF-1.6, NCAS-AMF-2.0.0'
-    else:
-        data_source = 'Vaisala MW41 sounding system'
-        conventions = 'CF-1.6'
-
-    # Global attributes
-    dataset_out.Conventions = conventions
-    dataset_out.source = data_source
-    dataset_out.instrument_manufacturer = 'Vaisala'
-    dataset_out.instrument_model = (radiosonde_metadata["Sonde type"]
-                                    + ' (software v' + radiosonde_metadata["Sonde software version"] + ')'
-                                    )
-    dataset_out.instrument_serial_number = radiosonde_metadata["Sonde serial number"]
-    dataset_out.instrument_software = radiosonde_metadata["Software version"].split(' ')[0]
-    dataset_out.instrument_software_version = radiosonde_metadata["Software version"].split(' ')[1]
+    def __init__(self, profile='default', quantize=True, chunk_size=None, overrides=None):
+        # overrides maps variable names to createVariable keyword arguments that replace the profile's, e.g.
+        # {'air_pressure': {'least_significant_digit': 3}}
+        self.profile = profile
+        self.quantize = quantize
+        self.chunk_size = chunk_size
+        self.overrides = overrides or {}
+
+    def variable_kwargs(self, variable_name, dimension_length):
+        kwargs = dict(COMPRESSION_PROFILES[self.profile])
+        if self.quantize and variable_name in LEAST_SIGNIFICANT_DIGITS:
+            kwargs['least_significant_digit'] = LEAST_SIGNIFICANT_DIGITS[variable_name]
+        if self.chunk_size is not None:
+            kwargs['chunksizes'] = (max(1, min(self.chunk_size, dimension_length)),)
+        kwargs.update(self.overrides.get(variable_name, {}))
+        return kwargs
+
+    def valid_range(self, variable_name, value_range):
+        # valid_min/valid_max for a float32 variable whose unquantised data spans value_range. Quantising can move
+        # a value by up to half a step, so the range is widened by a whole step: otherwise the extreme samples
+        # land just outside it and readers mask them as missing.
+        step = 10.0 ** -self.variable_kwargs(variable_name, 1).get('least_significant_digit', np.inf)
+        return np.float32(value_range[0] - step), np.float32(value_range[1] + step)
+
+    def settings(self):
+        # What the manifest records, so changing the compression or quantisation makes an incremental run
+        # reconvert the files written with the old settings
+        return {'profile': self.profile, 'quantize': self.quantize, 'chunk_size': self.chunk_size,
+                'overrides': self.overrides}
+
+
+# The createVariable keyword arguments --variable-compression may set, and how to read their values
+VARIABLE_COMPRESSION_KEYS = {'zlib': 'bool', 'complevel': 'int', 'shuffle': 'bool', 'fletcher32': 'bool',
+                             'least_significant_digit': 'int'}
+
+
+def variable_compression_overrides(specifications):
+    # NetcdfCompression overrides from 'VAR:key=value[,key=value...]' strings, e.g.
+    # 'air_pressure:least_significant_digit=3,complevel=9'. Later settings for a variable win.
+    overrides = {}
+    for specification in specifications:
+        variable_name, _, settings = specification.partition(':')
+        if not variable_name or not settings:
+            raise ValueError(f"Expected VAR:key=value[,key=value...], got {specification!r}")
+        for setting in settings.split(','):
+            key, _, value = setting.partition('=')
+            if key not in VARIABLE_COMPRESSION_KEYS or not value:
+                raise ValueError(f"Bad setting {setting!r} for {variable_name}, expected key=value with key one "
+                                 f"of {', '.join(VARIABLE_COMPRESSION_KEYS)}")
+            if VARIABLE_COMPRESSION_KEYS[key] == 'int' and value.lstrip('-').isdigit():
+                value = int(value)
+            elif VARIABLE_COMPRESSION_KEYS[key] == 'bool' and value.lower() in ('true', 'false'):
+                value = value.lower() == 'true'
+            else:
+                expected = 'an integer' if VARIABLE_COMPRESSION_KEYS[key] == 'int' else 'true or false'
+                raise ValueError(f"Bad setting {setting!r} for {variable_name}, expected {expected}")
+            overrides.setdefault(variable_name, {})[key] = value
+    return overrides
+
+
+@contextlib.contextmanager
+def atomic_netcdf_dataset(nc_path, **kwargs):
+    # Write to a temporary file next to the target and only rename it into place once it has been closed
+    # cleanly, so a crash or a bad sonde never leaves a truncated product in the output tree.
+    tmp_nc_path = f"{nc_path}.{os.getpid()}.tmp"
+    dataset_out = nc.Dataset(tmp_nc_path, 'w', **kwargs)
+    try:
+        yield dataset_out
+    except BaseException:
+        dataset_out.close()
+        os.remove(tmp_nc_path)
+        raise
+    dataset_out.close()
+    os.replace(tmp_nc_path, nc_path)
+
+
+def sonde_epoch_seconds(time_utc, start_time_dt):
+    # Convert the HH:MM:SS TimeUTC column to seconds since 1970 in one vectorised pass. The files only carry a
+    # time of day, so the date comes from the balloon release time and a day is added every time the clock
+    # wraps back past midnight; otherwise flights crossing 00:00 UTC would run backwards in time.
+    seconds_of_day = (time_utc.str.strip_chars().str.to_time("%H:%M:%S").cast(pl.Int64) // 1_000_000_000).to_numpy()
+    rollovers = np.concatenate(([0], np.cumsum(np.diff(seconds_of_day) < -SECONDS_PER_DAY // 2)))
+
+    # The first sample may fall either side of midnight from the release time (e.g. a pre-launch record at
+    # 23:59:50 for a release at 00:00:05), so work out which day it belongs to first.
+    release_seconds_of_day = start_time_dt.hour * 3600 + start_time_dt.minute * 60 + start_time_dt.second
+    first_day = 0
+    if seconds_of_day[0] - release_seconds_of_day > SECONDS_PER_DAY // 2:
+        first_day = -1
+    elif release_seconds_of_day - seconds_of_day[0] > SECONDS_PER_DAY // 2:
+        first_day = 1
+
+    release_day = dt.datetime(start_time_dt.year, start_time_dt.month, start_time_dt.day)
+    release_day_epoch = (release_day - EPOCH).total_seconds()
+    return release_day_epoch + SECONDS_PER_DAY * (rollovers + first_day) + seconds_of_day.astype(np.float64)
+
+
+def epoch_to_datetime(epoch_seconds):
+    return EPOCH + dt.timedelta(seconds=float(epoch_seconds))
+
+
+def prepare_sonde_columns(df, radiosonde_metadata, recreate_elapsed_time=False):
+    # Add the columns the writers need but the EDT files don't carry directly: epoch time, temperature in
+    # Kelvin and, where it is missing, elapsed time since the first sample.
+    sonde_time = sonde_epoch_seconds(df["TimeUTC"], radiosonde_metadata['start_time_dt'])
+    df = df.with_columns(
+        pl.Series("EpochTime", sonde_time),
+        (pl.col("Temp").cast(pl.Float64) + 273.15).alias("TempK"),
+    )
+    if recreate_elapsed_time or "Elapsed time" not in df.columns:
+        df = df.with_columns(pl.Series("Elapsed time", sonde_time - sonde_time[0]))
+    return df
+
+
+def column_statistics(df, columns):
+    # Min and max of every column in one vectorised query. NaNs are treated as missing, so they can't leak into
+    # valid_min/valid_max the way they did with Python's min()/max(). An all-missing column gives NaN.
+    values = [pl.col(column).cast(pl.Float64).fill_nan(None) for column in columns]
+    stats = df.select(
+        [value.min().fill_null(float('nan')).alias(f"min:{column}") for column, value in zip(columns, values)]
+        + [value.max().fill_null(float('nan')).alias(f"max:{column}") for column, value in zip(columns, values)]
+    ).row(0, named=True)
+    return {column: (stats[f"min:{column}"], stats[f"max:{column}"]) for column in columns}
+
+
+def geospatial_bounds_string(stats):
+    return (
+            f'{stats["Lat"][0]:0.6f}' + 'N ' # ('N' if stats["Lat"][0] >= 0 else 'S') + ' '
+            + f'{stats["Lon"][0]:0.6f}' + 'E, ' # ('E' if stats["Lon"][0] >= 0 else 'W')) + ', '
+            + f'{stats["Lat"][1]:0.6f}' + 'N ' # ('N' if stats["Lat"][1] >= 0 else 'S') + ' '
+            + f'{stats["Lon"][1]:0.6f}' + 'E' # ('E' if stats["Lon"][1] >= 0 else 'W')
+            )
+
+
+def set_project_attributes(dataset_out, current_time_string):
+    # Global attributes shared by every WOEST sonde product
     dataset_out.creator_name = 'Dr Hugo Ricketts'
     dataset_out.creator_email = 'hugo.ricketts@ncas.ac.uk'
     dataset_out.creator_url = 'https://orcid.org/0000-0002-1708-2431'
     dataset_out.institution = 'National Centre for Atmospheric Science (NCAS)'
     dataset_out.processing_software_url = 'https://github.com/gapintheclouds/woest-sondes'
-    dataset_out.processing_software_version = software_version_number
-    dataset_out.calibration_sensitivity = 'Not Applicable'
-    dataset_out.calibration_certification_date = 'N/A'
-    dataset_out.calibration_certification_url = 'N/A'
-    dataset_out.sampling_interval = f"{sampling_interval} {'second' if sampling_interval == 1 else 'seconds'}"
-    dataset_out.averaging_interval = f"{sampling_interval} {'second' if sampling_interval == 1 else 'seconds'}"
-    dataset_out.product_version = product_version_number
+    dataset_out.processing_software_version = SOFTWARE_VERSION_NUMBER
+    dataset_out.product_version = PRODUCT_VERSION_NUMBER
     dataset_out.processing_level = 1
     dataset_out.last_revised_date = current_time_string
     dataset_out.project = 'WesCon – Observing the Evolving Structures of Turbulence (WOEST)'
@@ -145,198 +283,202 @@ def save_netcdf_file(df, radiosonde_metadata, netcdf_dir, current_edt_filename):
     dataset_out.project_principal_investigator_email = 'ryan.neely@ncas.ac.uk'
     dataset_out.project_principal_investigator_url = 'https://orcid.org/0000-0003-4560-4812'
     dataset_out.licence = "".join(['Data usage licence - UK Government Open Licence agreement: ',
-                                    'http://www.nationalarchives.gov.uk/doc/open-government-licence'])
-    dataset_out.acknowledgement = "".join([f'Acknowledgement of {sonde_system_info.data_provider} as the ',
-                                            'data provider is required whenever and wherever these data are used'])
-    dataset_out.platform = sonde_system_info.station_name
-    dataset_out.platform_type = 'moving_platform'
-    dataset_out.deployment_mode = 'trajectory'
-    dataset_out.title = 'Radiosonde ascent'
-    dataset_out.featureType = 'timeSeriesProfile'
-    dataset_out.time_coverage_start = sonde_time_dt[0].strftime('%Y-%m-%dT%H:%M:%S')
-    dataset_out.time_coverage_end = sonde_time_dt[-1].strftime('%Y-%m-%dT%H:%M:%S')
-    dataset_out.geospatial_bounds = lat_lon_string
-    dataset_out.platform_altitude = radiosonde_metadata["Release point height from sea level"]
-    dataset_out.location_keywords = sonde_system_info.station_name
+                                   'http://www.nationalarchives.gov.uk/doc/open-government-licence'])
     dataset_out.amf_vocabularies_release = 'https://github.com/ncasuk/AMF_CVs/releases/tag/v2.0.0'
-    dataset_out.history = "".join([current_time_string, ' - v1.1: Changed station names to match CEDA platforms. Corrected valid_min and valid_max float types.\n',
-                                   'v1.0.1: Updated data provider acknowledgement.\n',
-                                   'v1.0: Initial processing. Flags not implemented yet.'])
-    dataset_out.comment = (f"Instrument owner: {sonde_system_info.system_owner}, "
-                           f"Instrument operator: {sonde_system_info.system_operator}, "
-                           f"Original raw data: {current_edt_filename}")
-
-    # Set up variables
-    times = dataset_out.createVariable('time', np.double, ('time',))
-    times.dimension = 'time'
+
+
+def create_sonde_variables(dataset_out, dimension, stats, time_range, this_fill_value, compression=None):
+    # Set up the time and data variables along `dimension`: 'time' in the per-sonde files, the ragged 'obs'
+    # dimension in the campaign files. stats are from column_statistics, time_range is (first, last) epoch time.
+    compression = compression or NetcdfCompression()
+    dimension_length = len(dataset_out.dimensions[dimension])
+    sonde_time_start = epoch_to_datetime(time_range[0])
+    sonde_time_end = epoch_to_datetime(time_range[1])
+
+    times = dataset_out.createVariable('time', np.double, (dimension,),
+                                       **compression.variable_kwargs('time', dimension_length))
+    times.dimension = dimension
     times.units = 'seconds since 1970-01-01 00:00:00'
     times.standard_name = 'time'
     times.long_name = 'Time (seconds since 1970-01-01 00:00:00)'
     times.axis = 'T'
-    times.valid_min = (sonde_time_dt[0] - dt.datetime(1970, 1, 1, 0, 0, 0)).total_seconds()
-    times.valid_max = (sonde_time_dt[-1] - dt.datetime(1970, 1, 1, 0, 0, 0)).total_seconds()
+    times.valid_min = float(time_range[0])
+    times.valid_max = float(time_range[1])
     times.calendar = 'standard'
 
-    day_of_year = dataset_out.createVariable('day_of_year', np.float32, ('time',))
-    day_of_year.dimension = 'time'
+    day_of_year = dataset_out.createVariable('day_of_year', np.float32, (dimension,),
+                                             **compression.variable_kwargs('day_of_year', dimension_length))
+    day_of_year.dimension = dimension
     day_of_year.units = '1'
     day_of_year.standard_name = ''
     day_of_year.long_name = 'Day of Year'
-    day_of_year.valid_min = sonde_time_dt[0].timetuple().tm_yday
-    day_of_year.valid_max = sonde_time_dt[-1].timetuple().tm_yday
+    day_of_year.valid_min = sonde_time_start.timetuple().tm_yday
+    day_of_year.valid_max = sonde_time_end.timetuple().tm_yday
 
-    year = dataset_out.createVariable('year', np.int32, ('time',))
-    year.dimension = 'time'
+    year = dataset_out.createVariable('year', np.int32, (dimension,),
+                                      **compression.variable_kwargs('year', dimension_length))
+    year.dimension = dimension
     year.units = '1'
     year.standard_name = ''
     year.long_name = 'Year'
-    year.valid_min = sonde_time_dt[0].year
-    year.valid_max = sonde_time_dt[-1].year
+    year.valid_min = sonde_time_start.year
+    year.valid_max = sonde_time_end.year
 
-    month = dataset_out.createVariable('month', np.int32, ('time',))
-    month.dimension = 'time'
+    month = dataset_out.createVariable('month', np.int32, (dimension,),
+                                       **compression.variable_kwargs('month', dimension_length))
+    month.dimension = dimension
     month.units = '1'
     month.standard_name = ''
     month.long_name = 'Month'
     month.valid_min = 1
     month.valid_max = 12
 
-    day = dataset_out.createVariable('day', np.int32, ('time',))
-    day.dimension = 'time'
+    day = dataset_out.createVariable('day', np.int32, (dimension,),
+                                     **compression.variable_kwargs('day', dimension_length))
+    day.dimension = dimension
     day.units = '1'
     day.standard_name = ''
     day.long_name = 'Day'
     day.valid_min = 1
     day.valid_max = 31
 
-    hour = dataset_out.createVariable('hour', np.int32, ('time',))
-    hour.dimension = 'time'
+    hour = dataset_out.createVariable('hour', np.int32, (dimension,),
+                                      **compression.variable_kwargs('hour', dimension_length))
+    hour.dimension = dimension
     hour.units = '1'
     hour.standard_name = ''
     hour.long_name = 'Hour'
     hour.valid_min = 0
     hour.valid_max = 23
 
-    minute = dataset_out.createVariable('minute', np.int32, ('time',))
-    minute.dimension = 'time'
+    minute = dataset_out.createVariable('minute', np.int32, (dimension,),
+                                        **compression.variable_kwargs('minute', dimension_length))
+    minute.dimension = dimension
     minute.units = '1'
     minute.standard_name = ''
     minute.long_name = 'Minute'
     minute.valid_min = 0
     minute.valid_max = 59
 
-    second = dataset_out.createVariable('second', np.float32, ('time',))
-    second.dimension = 'time'
+    second = dataset_out.createVariable('second', np.float32, (dimension,),
+                                        **compression.variable_kwargs('second', dimension_length))
+    second.dimension = dimension
     second.units = '1'
     second.standard_name = ''
     second.long_name = 'Second'
     second.valid_min = 0
     second.valid_max = np.float32(59.99999)
 
-    altitudes = dataset_out.createVariable('altitude', np.float32, 'time', fill_value=this_fill_value)
-    altitudes.dimension = 'time'
+    altitudes = dataset_out.createVariable('altitude', np.float32, (dimension,), fill_value=this_fill_value,
+                                           **compression.variable_kwargs('altitude', dimension_length))
+    altitudes.dimension = dimension
     altitudes.units = 'm'
     altitudes.standard_name = 'altitude'
     altitudes.long_name = 'Geometric height above geoid (WGS 84).'
     altitudes.axis = 'Z'
-    altitudes.valid_min = np.float32(min(df["GpsHeightMSL"][:]))
-    altitudes.valid_max = np.float32(max(df["GpsHeightMSL"][:]))
+    altitudes.valid_min, altitudes.valid_max = compression.valid_range('altitude', stats["GpsHeightMSL"])
     altitudes.cell_methods = 'time: point'
 
-    latitudes = dataset_out.createVariable('latitude', np.float32, ('time',), fill_value=this_fill_value)
-    latitudes.dimension = 'time'
+    latitudes = dataset_out.createVariable('latitude', np.float32, (dimension,), fill_value=this_fill_value,
+                                           **compression.variable_kwargs('latitude', dimension_length))
+    latitudes.dimension = dimension
     latitudes.units = 'degrees_north'
     latitudes.standard_name = 'latitude'
     latitudes.long_name = 'Latitude'
     latitudes.axis = 'Y'
-    latitudes.valid_min = np.float32(min(df["Lat"][:]))
-    latitudes.valid_max = np.float32(max(df["Lat"][:]))
+    latitudes.valid_min, latitudes.valid_max = compression.valid_range('latitude', stats["Lat"])
     latitudes.cell_methods = 'time: point'
 
-    longitudes = dataset_out.createVariable('longitude', np.float32, ('time',), fill_value=this_fill_value)
-    longitudes.dimension = 'time'
+    longitudes = dataset_out.createVariable('longitude', np.float32, (dimension,), fill_value=this_fill_value,
+                                            **compression.variable_kwargs('longitude', dimension_length))
+    longitudes.dimension = dimension
     longitudes.units = 'degrees_east'
     longitudes.standard_name = 'longitude'
     longitudes.long_name = 'Longitude'
     longitudes.axis = 'X'
-    longitudes.valid_min = np.float32(min(df["Lon"][:]))
-    longitudes.valid_max = np.float32(max(df["Lon"][:]))
+    longitudes.valid_min, longitudes.valid_max = compression.valid_range('longitude', stats["Lon"])
     longitudes.cell_methods = 'time: point'
 
-    air_pressures = dataset_out.createVariable('air_pressure', np.float32, ('time',), fill_value=this_fill_value)
-    air_pressures.dimension = 'time'
+    air_pressures = dataset_out.createVariable('air_pressure', np.float32, (dimension,),
+                                               fill_value=this_fill_value,
+                                               **compression.variable_kwargs('air_pressure', dimension_length))
+    air_pressures.dimension = dimension
     air_pressures.units = 'hPa'
     air_pressures.standard_name = 'air_pressure'
     air_pressures.long_name = 'Air Pressure'
-    air_pressures.valid_min = np.float32(min(df["P"][:]))
-    air_pressures.valid_max = np.float32(max(df["P"][:]))
+    air_pressures.valid_min, air_pressures.valid_max = compression.valid_range('air_pressure', stats["P"])
     air_pressures.cell_methods = 'time: point'
     air_pressures.coordinates = 'latitude longitude altitude'
 
-    air_temperatures = dataset_out.createVariable('air_temperature', np.float32, ('time',), fill_value=this_fill_value)
-    air_temperatures.dimension = 'time'
+    air_temperatures = dataset_out.createVariable('air_temperature', np.float32, (dimension,),
+                                                  fill_value=this_fill_value,
+                                                  **compression.variable_kwargs('air_temperature', dimension_length))
+    air_temperatures.dimension = dimension
     air_temperatures.units = 'K'
     air_temperatures.standard_name = 'air_temperature'
     air_temperatures.long_name = 'AirTemperature'
-    air_temperatures.valid_min = np.float32(min(df["TempK"][:]))
-    air_temperatures.valid_max = np.float32(max(df["TempK"][:]))
+    air_temperatures.valid_min, air_temperatures.valid_max = compression.valid_range('air_temperature', stats["TempK"])
     air_temperatures.cell_methods = 'time: point'
     air_temperatures.coordinates = 'latitude longitude altitude'
 
-    relative_humiditys = dataset_out.createVariable('relative_humidity', np.float32, ('time',),
-                                                    fill_value=this_fill_value)
-    relative_humiditys.dimension = 'time'
+    relative_humiditys = dataset_out.createVariable(
+        'relative_humidity', np.float32, (dimension,), fill_value=this_fill_value,
+        **compression.variable_kwargs('relative_humidity', dimension_length))
+    relative_humiditys.dimension = dimension
     relative_humiditys.units = '%'
     relative_humiditys.standard_name = 'relative_humidity'
     relative_humiditys.long_name = 'Relative Humidity'
-    relative_humiditys.valid_min = np.float32(min(df["RH"][:]))
-    relative_humiditys.valid_max = np.float32(max(df["RH"][:]))
+    relative_humiditys.valid_min, relative_humiditys.valid_max = compression.valid_range(
+        'relative_humidity', stats["RH"])
     relative_humiditys.cell_methods = 'time: point'
     relative_humiditys.coordinates = 'latitude longitude altitude'
 
-    wind_speeds = dataset_out.createVariable('wind_speed', np.float32, ('time',), fill_value=this_fill_value)
-    wind_speeds.dimension = 'time'
+    wind_speeds = dataset_out.createVariable('wind_speed', np.float32, (dimension,), fill_value=this_fill_value,
+                                             **compression.variable_kwargs('wind_speed', dimension_length))
+    wind_speeds.dimension = dimension
     wind_speeds.units = 'm s-1'
     wind_speeds.standard_name = 'wind_speed'
     wind_speeds.long_name = 'Wind Speed'
-    wind_speeds.valid_min = np.float32(min(df["Speed"][:]))
-    wind_speeds.valid_max = np.float32(max(df["Speed"][:]))
+    wind_speeds.valid_min, wind_speeds.valid_max = compression.valid_range('wind_speed', stats["Speed"])
     wind_speeds.cell_methods = 'time: point'
     wind_speeds.coordinates = 'latitude longitude altitude'
 
-    wind_from_directions = dataset_out.createVariable('wind_from_direction', np.float32, ('time',),
-                                                      fill_value=this_fill_value)
-    wind_from_directions.dimension = 'time'
+    wind_from_directions = dataset_out.createVariable(
+        'wind_from_direction', np.float32, (dimension,), fill_value=this_fill_value,
+        **compression.variable_kwargs('wind_from_direction', dimension_length))
+    wind_from_directions.dimension = dimension
     wind_from_directions.units = 'degree'
     wind_from_directions.standard_name = 'wind_from_direction'
     wind_from_directions.long_name = 'Wind From Direction'
-    wind_from_directions.valid_min = np.float32(min(df["Dir"][:]))
-    wind_from_directions.valid_max = np.float32(max(df["Dir"][:]))
+    wind_from_directions.valid_min, wind_from_directions.valid_max = compression.valid_range(
+        'wind_from_direction', stats["Dir"])
     wind_from_directions.cell_methods = 'time: point'
     wind_from_directions.coordinates = 'latitude longitude altitude'
 
-    upward_balloon_velocitys = dataset_out.createVariable('upward_balloon_velocity', np.float32, ('time',),
-                                                          fill_value=this_fill_value)
-    upward_balloon_velocitys.dimension = 'time'
+    upward_balloon_velocitys = dataset_out.createVariable(
+        'upward_balloon_velocity', np.float32, (dimension,), fill_value=this_fill_value,
+        **compression.variable_kwargs('upward_balloon_velocity', dimension_length))
+    upward_balloon_velocitys.dimension = dimension
     upward_balloon_velocitys.units = 'm s-1'
     upward_balloon_velocitys.standard_name = ''
     upward_balloon_velocitys.long_name = 'Balloon Ascent Rate'
-    upward_balloon_velocitys.valid_min = np.float32(min(df["AscRate"][:]))
-    upward_balloon_velocitys.valid_max = np.float32(max(df["AscRate"][:]))
+    upward_balloon_velocitys.valid_min, upward_balloon_velocitys.valid_max = compression.valid_range(
+        'upward_balloon_velocity', stats["AscRate"])
     upward_balloon_velocitys.cell_methods = 'time: point'
     upward_balloon_velocitys.coordinates = 'latitude longitude altitude'
 
-    elapsed_times = dataset_out.createVariable('elapsed_time', np.float32, ('time',), fill_value=this_fill_value)
-    elapsed_times.dimension = 'time'
+    elapsed_times = dataset_out.createVariable('elapsed_time', np.float32, (dimension,),
+                                               fill_value=this_fill_value,
+                                               **compression.variable_kwargs('elapsed_time', dimension_length))
+    elapsed_times.dimension = dimension
     elapsed_times.units = 's'
     elapsed_times.standard_name = ''
     elapsed_times.long_name = 'Elapsed Time'
-    elapsed_times.valid_min = np.float32(min(df["Elapsed time"][:]))
-    elapsed_times.valid_max = np.float32(max(df["Elapsed time"][:]))
+    elapsed_times.valid_min, elapsed_times.valid_max = compression.valid_range('elapsed_time', stats["Elapsed time"])
 
-    # qc_flags = dataset_out.createVariable('qc_flag', np.byte, ('time',), fill_value=this_fill_value)
+    # qc_flags = dataset_out.createVariable('qc_flag', np.byte, (dimension,), fill_value=this_fill_value)
     # qc_flags.type = 'byte'
-    # qc_flags.dimension = 'time'
+    # qc_flags.dimension = dimension
     # qc_flags.units = '1'
     # qc_flags.standard_name = ''
     # qc_flags.long_name = 'Data Quality flag'
@@ -347,46 +489,547 @@ def save_netcdf_file(df, radiosonde_metadata, netcdf_dir, current_edt_filename):
     #                           'suspect_data_horizontal_wind_speed_equals_0_m_s-1\n'
     #                           )
 
-    # replace NaNs with the fill value (done after min and max operations to avoid minimum reading fill value)
-    df = df.fill_nan(this_fill_value)
-
-    # Write data
-    dataset_out['time'][:] = nc.date2num(sonde_time_dt, dataset_out['time'].units)
-    dataset_out['altitude'][:] = df["GpsHeightMSL"][:]
-    dataset_out['latitude'][:] = df["Lat"][:]
-    dataset_out['longitude'][:] = df["Lon"][:]
-    dataset_out['air_pressure'][:] = df["P"][:]
-    dataset_out['air_temperature'][:] = df["TempK"][:]
-    dataset_out['relative_humidity'][:] = df["RH"][:]
-    dataset_out['wind_speed'][:] = df["Speed"][:]
-    dataset_out['wind_from_direction'][:] = df["Dir"][:]
-    dataset_out['upward_balloon_velocity'][:] = df["AscRate"][:]
-    dataset_out['elapsed_time'][:] = df["Elapsed time"][:]
+
+def create_derived_variables(dataset_out, dimension, stats, this_fill_value, compression=None,
+                             parcel_dimensions=()):
+    # Set up the derive_sondes variables: the per-level ones along `dimension`, and the surface parcel ones as
+    # scalars in the per-sonde files or along parcel_dimensions=('trajectory',) in the campaign files.
+    compression = compression or NetcdfCompression()
+    dimension_length = len(dataset_out.dimensions[dimension])
+    for variable_name, (column, units, standard_name, long_name) in derive_sondes.DERIVED_VARIABLES.items():
+        derived_variable = dataset_out.createVariable(variable_name, np.float32, (dimension,),
+                                                      fill_value=this_fill_value,
+                                                      **compression.variable_kwargs(variable_name, dimension_length))
+        derived_variable.dimension = dimension
+        derived_variable.units = units
+        derived_variable.standard_name = standard_name
+        derived_variable.long_name = long_name
+        derived_variable.valid_min, derived_variable.valid_max = compression.valid_range(variable_name, stats[column])
+        derived_variable.cell_methods = 'time: point'
+        derived_variable.coordinates = 'latitude longitude altitude'
+
+    for variable_name, (key, units, standard_name, long_name) in derive_sondes.PARCEL_VARIABLES.items():
+        parcel_variable = dataset_out.createVariable(variable_name, np.float32, parcel_dimensions,
+                                                     fill_value=this_fill_value)
+        parcel_variable.units = units
+        parcel_variable.standard_name = standard_name
+        parcel_variable.long_name = long_name
+
+
+def write_derived_variables(dataset_out, df, parcels, this_fill_value):
+    # Write the derived columns and the surface parcel values of every sonde in df (in the same order as
+    # parcels) into the variables from create_derived_variables.
+    derived_columns = [column for column, _, _, _ in derive_sondes.DERIVED_VARIABLES.values()]
+    df = df.with_columns(pl.col(derived_columns).cast(pl.Float64).fill_nan(this_fill_value).fill_null(this_fill_value))
+    for variable_name, (column, _, _, _) in derive_sondes.DERIVED_VARIABLES.items():
+        dataset_out[variable_name][:] = df[column].to_numpy()
+    for variable_name, (key, _, _, _) in derive_sondes.PARCEL_VARIABLES.items():
+        values = np.array([parcel[key] for parcel in parcels])
+        values = np.where(np.isnan(values), this_fill_value, values)
+        dataset_out[variable_name][:] = values if dataset_out[variable_name].dimensions else values[0]
+
+
+def write_sonde_variables(dataset_out, df, this_fill_value, start=0):
+    # Write the time and data columns of one sonde into the variables from create_sonde_variables, starting at
+    # index `start` along their dimension.
+    # replace NaNs and nulls with the fill value (done after min and max operations to avoid minimum reading
+    # fill value)
+    df = df.with_columns(
+        pl.col(list(VARIABLE_COLUMNS.values())).cast(pl.Float64)
+        .fill_nan(this_fill_value).fill_null(this_fill_value)
+    )
+
+    stop = start + len(df)
+    dataset_out['time'][start:stop] = df["EpochTime"].to_numpy()
+    for variable_name, column in VARIABLE_COLUMNS.items():
+        dataset_out[variable_name][start:stop] = df[column].to_numpy()
     # NOTE: Check first altitudes! Look wrong...
 
-    # Close NetCDF file
-    dataset_out.close()
 
+def save_netcdf_file(df, radiosonde_metadata, netcdf_dir, current_edt_filename, compression=None,
+                     catalog_entry=None, derive=False, index_segments=None):
+    # If catalog_entry (a dict) is given, it is filled with the sonde's catalog row once the file is written, and
+    # if index_segments (a list) is given, it is extended with the sonde's index_sondes segment boxes.
+    # With derive=True the derive_sondes quantities are added as extra variables.
+    # Replace nulls with NaNs
+    this_fill_value = -1.00e+20
 
-def convert_sondes_to_netcdf(raw_dir, netcdf_dir):
-    # stations = ['Ash_Farm', 'Castle_Cary', 'Chilbolton', 'Larkhill', 'Netheravon', 'Reading', 'Spire_View']
-    stations = ['Ash_Farm', 'Chilbolton', 'Larkhill', 'Reading', 'Spire_View']  # edited list
-    file_search = 'edt1sdataforv217*.txt'
+    # Load sonde system metadata
+    sonde_system_info = SondeInfo(radiosonde_metadata['Station name'])
 
-    for station in stations:
-        current_search = raw_dir + station + '/' + file_search
-        edt_file_list = sorted(glob.glob(current_search))
+    # Convert time strings to epoch seconds and make sure units are right.
+    # Reading is missing elapsed time, so it's recreated here.
+    with instrument_sondes.stage('time_conversion') as record:
+        df = prepare_sonde_columns(df, radiosonde_metadata,
+                                   recreate_elapsed_time=sonde_system_info.station_name == 'reading')
+        record['rows'] = len(df)
+    statistics_columns = list(VARIABLE_COLUMNS.values())
+    if derive:
+        with instrument_sondes.stage('derive') as record:
+            (df,), parcels = derive_sondes.derive_thermodynamics([df])
+            record['rows'] = len(df)
+        statistics_columns += [column for column, _, _, _ in derive_sondes.DERIVED_VARIABLES.values()]
+    sonde_time = df["EpochTime"].to_numpy()
+    sonde_time_start = epoch_to_datetime(sonde_time[0])
+    sonde_time_end = epoch_to_datetime(sonde_time[-1])
+    with instrument_sondes.stage('statistics') as record:
+        stats = column_statistics(df, statistics_columns)
+        record['rows'] = len(df)
 
-        # current_edt_file = edt_file_list[0]
+    product_version_number = PRODUCT_VERSION_NUMBER
+    current_time = dt.datetime.now(dt.timezone.utc)
+    current_time_string = current_time.strftime('%Y-%m-%dT%H:%M:%S') # %z: removed time zone
+    lat_lon_string = geospatial_bounds_string(stats)
+    sampling_interval = int(sonde_time[1] - sonde_time[0])
+
+    # Create NetCDF directories
+    nc_path = netcdf_file_path(netcdf_dir, sonde_system_info, radiosonde_metadata['start_time_dt'],
+                               product_version_number)
+    os.makedirs(os.path.dirname(nc_path), exist_ok=True)
+
+    # Open NetCDF file
+    print(nc_path)
+
+    with instrument_sondes.stage('netcdf_write') as record, \
+            atomic_netcdf_dataset(nc_path, format='NETCDF4_CLASSIC') as dataset_out:
+        # Set up dimensions
+        time_dim = dataset_out.createDimension('time', len(sonde_time))
+
+        # Set source
+        if sonde_system_info.station_name == 'ash-farm':
+            data_source = 'NCAS Vaisala Sounding Station unit 1'
+            conventions = 'CF-1.6, NCAS-AMF-2.0.0'
+        else:
+            data_source = 'Vaisala MW41 sounding system'
+            conventions = 'CF-1.6'
+
+        # Global attributes
+        dataset_out.Conventions = conventions
+        dataset_out.source = data_source
+        dataset_out.instrument_manufacturer = 'Vaisala'
+        dataset_out.instrument_model = (radiosonde_metadata["Sonde type"]
+                                        + ' (software v' + radiosonde_metadata["Sonde software version"] + ')'
+                                        )
+        dataset_out.instrument_serial_number = radiosonde_metadata["Sonde serial number"]
+        dataset_out.instrument_software = radiosonde_metadata["Software version"].split(' ')[0]
+        dataset_out.instrument_software_version = radiosonde_metadata["Software version"].split(' ')[1]
+        set_project_attributes(dataset_out, current_time_string)
+        dataset_out.calibration_sensitivity = 'Not Applicable'
+        dataset_out.calibration_certification_date = 'N/A'
+        dataset_out.calibration_certification_url = 'N/A'
+        dataset_out.sampling_interval = f"{sampling_interval} {'second' if sampling_interval == 1 else 'seconds'}"
+        dataset_out.averaging_interval = f"{sampling_interval} {'second' if sampling_interval == 1 else 'seconds'}"
+        dataset_out.acknowledgement = "".join([f'Acknowledgement of {sonde_system_info.data_provider} as the ',
+                                                'data provider is required whenever and wherever these data are used'])
+        dataset_out.platform = sonde_system_info.station_name
+        dataset_out.platform_type = 'moving_platform'
+        dataset_out.deployment_mode = 'trajectory'
+        dataset_out.title = 'Radiosonde ascent'
+        dataset_out.featureType = 'timeSeriesProfile'
+        dataset_out.time_coverage_start = sonde_time_start.strftime('%Y-%m-%dT%H:%M:%S')
+        dataset_out.time_coverage_end = sonde_time_end.strftime('%Y-%m-%dT%H:%M:%S')
+        dataset_out.geospatial_bounds = lat_lon_string
+        dataset_out.platform_altitude = radiosonde_metadata["Release point height from sea level"]
+        dataset_out.location_keywords = sonde_system_info.station_name
+        dataset_out.history = "".join([current_time_string, ' - v1.1: Changed station names to match CEDA platforms. Corrected valid_min and valid_max float types.\n',
+                                       'v1.0.1: Updated data provider acknowledgement.\n',
+                                       'v1.0: Initial processing. Flags not implemented yet.'])
+        dataset_out.comment = (f"Instrument owner: {sonde_system_info.system_owner}, "
+                               f"Instrument operator: {sonde_system_info.system_operator}, "
+                               f"Original raw data: {current_edt_filename}")
+
+        # Set up variables
+        create_sonde_variables(dataset_out, 'time', stats, (sonde_time[0], sonde_time[-1]), this_fill_value,
+                               compression)
+        if derive:
+            create_derived_variables(dataset_out, 'time', stats, this_fill_value, compression)
+
+        # Write data
+        write_sonde_variables(dataset_out, df, this_fill_value)
+        if derive:
+            write_derived_variables(dataset_out, df, parcels, this_fill_value)
+        record['rows'] = len(df)
+    # Only known once the file has been closed and renamed into place
+    record['bytes_written'] = os.path.getsize(nc_path)
+
+    if catalog_entry is not None:
+        catalog_entry.update(catalog_sondes.catalog_row(
+            radiosonde_metadata, sonde_system_info.station_name, sonde_system_info.instrument_name,
+            (sonde_time[0], sonde_time[-1]), stats, len(df), nc_path, current_edt_filename, product_version_number))
+    if index_segments is not None:
+        # From the values as written, which quantisation may have moved, so the boxes hold what query() reads
+        index_segments.extend(index_sondes.read_segment_boxes(nc_path))
+
+    return nc_path
+
+
+def create_string_variable(dataset_out, name, dimension, values):
+    # NETCDF4_CLASSIC has no string type, so store fixed-width char arrays that netCDF4 decodes back to strings
+    encoded_values = [value.encode('utf-8') for value in values]
+    string_length = max([1] + [len(value) for value in encoded_values])
+    dataset_out.createDimension(f'{name}_strlen', string_length)
+    string_variable = dataset_out.createVariable(name, 'S1', (dimension, f'{name}_strlen'))
+    string_variable._Encoding = 'utf-8'
+    string_variable[:] = np.array(encoded_values, dtype=f'S{string_length}')
+    return string_variable
+
+
+def save_campaign_netcdf_file(sondes, nc_path, compression=None, derive=False):
+    # Write many sondes into one file using the CF contiguous ragged array representation (featureType
+    # trajectory): every sonde's observations are stored back to back along the 'obs' dimension and row_size
+    # gives the number that belong to each trajectory. sondes is a list of (df, radiosonde_metadata,
+    # current_edt_filename), with df already passed through prepare_sonde_columns. With derive=True the
+    # derive_sondes quantities are computed for all the sondes as one batch and added as extra variables.
+    this_fill_value = -1.00e+20
+
+    sondes = sorted(sondes, key=lambda sonde: sonde[1]['start_time_dt'])
+    data_columns = list(VARIABLE_COLUMNS.values())
+    if derive:
+        derived_dfs, parcels = derive_sondes.derive_thermodynamics([sonde_df for sonde_df, _, _ in sondes])
+        sondes = [(derived_df, radiosonde_metadata, current_edt_filename)
+                  for derived_df, (_, radiosonde_metadata, current_edt_filename) in zip(derived_dfs, sondes)]
+        data_columns += [column for column, _, _, _ in derive_sondes.DERIVED_VARIABLES.values()]
+    df = pl.concat([sonde_df.select(["EpochTime"] + data_columns) for sonde_df, _, _ in sondes],
+                   how='vertical_relaxed')
+    stats = column_statistics(df, data_columns)
+    sonde_time = df["EpochTime"].to_numpy()
+    time_range = (np.nanmin(sonde_time), np.nanmax(sonde_time))
+    sonde_system_infos = [SondeInfo(radiosonde_metadata['Station name']) for _, radiosonde_metadata, _ in sondes]
+    station_names = sorted({sonde_system_info.station_name for sonde_system_info in sonde_system_infos})
+
+    current_time = dt.datetime.now(dt.timezone.utc)
+    current_time_string = current_time.strftime('%Y-%m-%dT%H:%M:%S') # %z: removed time zone
+
+    os.makedirs(os.path.dirname(nc_path) or '.', exist_ok=True)
+    print(nc_path)
+
+    with atomic_netcdf_dataset(nc_path, format='NETCDF4_CLASSIC') as dataset_out:
+        # Set up dimensions
+        obs_dim = dataset_out.createDimension('obs', len(df))
+        trajectory_dim = dataset_out.createDimension('trajectory', len(sondes))
+
+        # Global attributes
+        dataset_out.Conventions = 'CF-1.6'
+        dataset_out.source = 'Vaisala radiosonde sounding systems'
+        dataset_out.instrument_manufacturer = 'Vaisala'
+        set_project_attributes(dataset_out, current_time_string)
+        dataset_out.acknowledgement = "".join([
+            'Acknowledgement of ',
+            ', '.join(sorted({sonde_system_info.data_provider for sonde_system_info in sonde_system_infos})),
+            ' as the data provider is required whenever and wherever these data are used'])
+        dataset_out.platform = ', '.join(station_names)
+        dataset_out.platform_type = 'moving_platform'
+        dataset_out.deployment_mode = 'trajectory'
+        dataset_out.title = 'Radiosonde ascents'
+        dataset_out.featureType = 'trajectory'
+        dataset_out.time_coverage_start = epoch_to_datetime(time_range[0]).strftime('%Y-%m-%dT%H:%M:%S')
+        dataset_out.time_coverage_end = epoch_to_datetime(time_range[1]).strftime('%Y-%m-%dT%H:%M:%S')
+        dataset_out.geospatial_bounds = geospatial_bounds_string(stats)
+        dataset_out.location_keywords = ', '.join(station_names)
+        dataset_out.comment = (f"Aggregation of {len(sondes)} radiosonde ascents, one trajectory per ascent. "
+                               f"Per-ascent metadata is held in the variables along the trajectory dimension.")
+
+        # Per-trajectory (sonde) variables
+        trajectories = create_string_variable(
+            dataset_out, 'trajectory', 'trajectory',
+            [f"{sonde_system_info.station_name}_{radiosonde_metadata['start_time_dt']:%Y%m%d-%H%M%S}"
+             for sonde_system_info, (_, radiosonde_metadata, _) in zip(sonde_system_infos, sondes)])
+        trajectories.cf_role = 'trajectory_id'
+        trajectories.long_name = 'Radiosonde ascent identifier'
+
+        row_sizes = dataset_out.createVariable('row_size', np.int32, ('trajectory',))
+        row_sizes.long_name = 'Number of observations for this trajectory'
+        row_sizes.sample_dimension = 'obs'
+        row_sizes[:] = np.array([len(sonde_df) for sonde_df, _, _ in sondes], dtype=np.int32)
+
+        release_times = dataset_out.createVariable('release_time', np.double, ('trajectory',))
+        release_times.units = 'seconds since 1970-01-01 00:00:00'
+        release_times.standard_name = 'time'
+        release_times.long_name = 'Balloon release time'
+        release_times.calendar = 'standard'
+        release_times[:] = np.array([(radiosonde_metadata['start_time_dt'] - EPOCH).total_seconds()
+                                     for _, radiosonde_metadata, _ in sondes])
+
+        platforms = create_string_variable(dataset_out, 'platform', 'trajectory',
+                                           [sonde_system_info.station_name for sonde_system_info in sonde_system_infos])
+        platforms.long_name = 'Launch station'
+        instrument_names = create_string_variable(dataset_out, 'instrument_name', 'trajectory',
+                                                  [sonde_system_info.instrument_name
+                                                   for sonde_system_info in sonde_system_infos])
+        instrument_names.long_name = 'Instrument name'
+        instrument_models = create_string_variable(
+            dataset_out, 'instrument_model', 'trajectory',
+            [radiosonde_metadata["Sonde type"] + ' (software v' + radiosonde_metadata["Sonde software version"] + ')'
+             for _, radiosonde_metadata, _ in sondes])
+        instrument_models.long_name = 'Sonde type and sonde software version'
+        serial_numbers = create_string_variable(dataset_out, 'instrument_serial_number', 'trajectory',
+                                                [radiosonde_metadata["Sonde serial number"]
+                                                 for _, radiosonde_metadata, _ in sondes])
+        serial_numbers.long_name = 'Sonde serial number'
+        software_versions = create_string_variable(dataset_out, 'instrument_software_version', 'trajectory',
+                                                   [radiosonde_metadata["Software version"]
+                                                    for _, radiosonde_metadata, _ in sondes])
+        software_versions.long_name = 'Sounding system software and version'
+        platform_altitudes = create_string_variable(dataset_out, 'platform_altitude', 'trajectory',
+                                                    [radiosonde_metadata["Release point height from sea level"]
+                                                     for _, radiosonde_metadata, _ in sondes])
+        platform_altitudes.long_name = 'Release point height from sea level'
+        raw_files = create_string_variable(dataset_out, 'raw_data_file', 'trajectory',
+                                           [current_edt_filename for _, _, current_edt_filename in sondes])
+        raw_files.long_name = 'Original raw data'
+
+        # Per-observation variables, as in the per-sonde files but along the ragged obs dimension
+        create_sonde_variables(dataset_out, 'obs', stats, time_range, this_fill_value, compression)
+        if derive:
+            create_derived_variables(dataset_out, 'obs', stats, this_fill_value, compression,
+                                     parcel_dimensions=('trajectory',))
+        for variable_name in list(VARIABLE_COLUMNS) + (list(derive_sondes.DERIVED_VARIABLES) if derive else []):
+            if 'coordinates' in dataset_out[variable_name].ncattrs():
+                dataset_out[variable_name].coordinates = 'time latitude longitude altitude'
+
+        # Write data in one contiguous block
+        write_sonde_variables(dataset_out, df, this_fill_value)
+        if derive:
+            write_derived_variables(dataset_out, df, parcels, this_fill_value)
+
+    return nc_path
+
+
+def read_prepared_sonde(current_edt_file, netcdf_dir):
+    # Read and prepare a single EDT file for a campaign file, reporting failure instead of raising.
+    result = {'file': current_edt_file, 'sonde': None, 'error': None}
+    try:
+        df, radiosonde_metadata, data_units = do_radiosondes(current_edt_file, netcdf_dir,
+                                                             columns=list(SONDE_COLUMN_TYPES))
+        sonde_system_info = SondeInfo(radiosonde_metadata['Station name'])
+        df = prepare_sonde_columns(df, radiosonde_metadata,
+                                   recreate_elapsed_time=sonde_system_info.station_name == 'reading')
+        result['sonde'] = (df.select(["EpochTime"] + list(VARIABLE_COLUMNS.values())), radiosonde_metadata,
+                           archive_sondes.edt_base_name(current_edt_file))
+    except Exception as error:
+        result['error'] = f"{type(error).__name__}: {error}"
+    return result
+
+
+def group_prepared_sondes(summary, aggregate='station'):
+    # Group the sondes read by read_prepared_sonde by station name (aggregate='station') or all together under
+    # None (aggregate='campaign')
+    groups = {}
+    for result in summary:
+        if result['error'] is None:
+            _, radiosonde_metadata, _ = result['sonde']
+            group = SondeInfo(radiosonde_metadata['Station name']).station_name if aggregate == 'station' else None
+            groups.setdefault(group, []).append(result['sonde'])
+    return groups
+
+
+def aggregate_netcdf_path(netcdf_dir, station_name, sondes, product_name):
+    # File name for a multi-sonde product (e.g. 'trajectories') covering `sondes`, for one station or, with
+    # station_name None, the whole campaign
+    first_date = min(radiosonde_metadata['start_time_dt'] for _, radiosonde_metadata, _ in sondes)
+    last_date = max(radiosonde_metadata['start_time_dt'] for _, radiosonde_metadata, _ in sondes)
+    date_string = f"{first_date:%Y%m%d}-{last_date:%Y%m%d}"
+    if station_name is None:
+        return os.path.join(netcdf_dir, f"radiosondes_woest_{date_string}_{product_name}_{PRODUCT_VERSION_NUMBER}.nc")
+    instrument_name = SondeInfo(sondes[0][1]['Station name']).instrument_name
+    return os.path.join(netcdf_dir, station_name,
+                        f"{instrument_name}_{station_name}_{date_string}_"
+                        f"sonde_woest_{product_name}_{PRODUCT_VERSION_NUMBER}.nc")
+
+
+def convert_sondes_to_campaign_netcdf(raw_dir, netcdf_dir, aggregate='station', workers=1, compression=None,
+                                      derive=False):
+    # Write one ragged-array file per station (aggregate='station') or one for the whole campaign
+    # (aggregate='campaign'). The files are rebuilt from the raw data each time.
+    summary = run_sonde_jobs(read_prepared_sonde, find_edt_files(raw_dir), workers, netcdf_dir)
+
+    for station_name, sondes in group_prepared_sondes(summary, aggregate).items():
+        nc_path = aggregate_netcdf_path(netcdf_dir, station_name, sondes, 'trajectories')
+        save_campaign_netcdf_file(sondes, nc_path, compression, derive)
+
+    for result in summary:
+        result.pop('sonde')
+    return summary
+
+
+def conversion_options(compression=None, derive=False):
+    # The output-shaping options of a conversion, as recorded in the manifest: an --incremental run with
+    # different ones (e.g. adding --derive) reconverts the files written without them
+    return {'compression': (compression or NetcdfCompression()).settings(), 'derive': derive}
+
+
+def count_masked_valid_samples(nc_path):
+    # Read-back check: the number of samples per variable that were written (aren't the fill value) but that a
+    # reader masks as missing anyway because they fall outside valid_min/valid_max. Should always be zero.
+    masked = {}
+    with nc.Dataset(nc_path) as dataset:
+        for name, variable in dataset.variables.items():
+            if 'valid_min' not in variable.ncattrs() or not variable.dimensions:
+                continue
+            variable.set_auto_mask(False)
+            values = variable[:]
+            fill_value = getattr(variable, '_FillValue', nc.default_fillvals[variable.dtype.str[1:]])
+            written = values != fill_value
+            outside = written & ((values < variable.valid_min) | (values > variable.valid_max))
+            if outside.any():
+                masked[name] = int(outside.sum())
+    return masked
+
+
+def convert_sonde_file(current_edt_file, netcdf_dir, compression=None, profile=False, derive=False):
+    # Convert a single EDT file, reporting failure instead of raising so one bad sonde doesn't stop a whole run.
+    # This is the unit of work handed to the process pool, so it must stay a picklable module-level function.
+    # With profile=True the stage timings are collected in whichever process runs it and returned in the result.
+    result = {'file': current_edt_file, 'output': None, 'error': None, 'catalog': {}, 'index': []}
+    if profile:
+        instrument_sondes.start_profiling()
+    try:
+        with instrument_sondes.stage('convert_file', current_edt_file) as record:
+            df, radiosonde_metadata, data_units = do_radiosondes(current_edt_file, netcdf_dir,
+                                                                 columns=list(SONDE_COLUMN_TYPES))
+            result['output'] = save_netcdf_file(df, radiosonde_metadata, netcdf_dir,
+                                                archive_sondes.edt_base_name(current_edt_file), compression,
+                                                catalog_entry=result['catalog'], derive=derive,
+                                                index_segments=result['index'])
+            record['rows'] = len(df)
+            record['bytes_read'] = archive_sondes.source_size_mtime(current_edt_file)[0]
+            record['bytes_written'] = os.path.getsize(result['output'])
+    except Exception as error:
+        result['error'] = f"{type(error).__name__}: {error}"
+    if profile:
+        result['profile'] = instrument_sondes.stop_profiling()
+    return result
+
+
+@contextlib.contextmanager
+def sonde_process_pool(workers):
+    # Use spawned rather than forked workers (polars' thread pool is not fork-safe) and share the cores out
+    # between them, so N processes each running polars don't oversubscribe the machine.
+    threads_per_worker = str(max(1, (os.cpu_count() or 1) // workers))
+    previous_max_threads = os.environ.get('POLARS_MAX_THREADS')
+    os.environ['POLARS_MAX_THREADS'] = threads_per_worker
+    try:
+        with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn')) as pool:
+            yield pool
+    finally:
+        if previous_max_threads is None:
+            del os.environ['POLARS_MAX_THREADS']
+        else:
+            os.environ['POLARS_MAX_THREADS'] = previous_max_threads
+
+
+def run_sonde_jobs(job, edt_file_list, workers, *job_args):
+    # Run job(current_edt_file, *job_args) for every file, in a process pool when workers > 1, and return the
+    # results in file order. Jobs must catch their own errors and return a dict with at least a 'file' key.
+    if workers <= 1:
+        results = []
         for current_edt_file in edt_file_list:
             print(current_edt_file)
-            df, radiosonde_metadata, data_units = do_radiosondes(current_edt_file, netcdf_dir)
-            save_netcdf_file(df, radiosonde_metadata, netcdf_dir, os.path.basename(current_edt_file))
+            results.append(job(current_edt_file, *job_args))
+        return results
+
+    with sonde_process_pool(workers) as pool:
+        futures = [pool.submit(job, current_edt_file, *job_args) for current_edt_file in edt_file_list]
+        for future in as_completed(futures):
+            print(future.result()['file'])
+        return [future.result() for future in futures]
+
+
+def convert_sondes_to_netcdf(raw_dir, netcdf_dir, workers=1, incremental=False, compression=None,
+                             profile_report=None, derive=False):
+    # profile_report is a .json or .csv path to write per-stage, per-file timings and counters to
+    start = time.perf_counter()
+    edt_file_list = find_edt_files(raw_dir)
+
+    # The manifest is always updated, but only consulted in incremental mode, so a full run can be used to
+    # rebuild it from scratch.
+    manifest = manifest_sondes.load_manifest(netcdf_dir)
+    if incremental:
+        edt_file_list = [current_edt_file for current_edt_file in edt_file_list
+                         if manifest_sondes.needs_conversion(manifest, raw_dir, current_edt_file,
+                                                             PRODUCT_VERSION_NUMBER, SOFTWARE_VERSION_NUMBER,
+                                                             conversion_options(compression, derive))]
+
+    summary = run_sonde_jobs(convert_sonde_file, edt_file_list, workers, netcdf_dir, compression,
+                             profile_report is not None, derive)
+
+    for result in summary:
+        if result['error'] is None:
+            manifest_sondes.record_conversion(manifest, raw_dir, result['file'], result['output'],
+                                              PRODUCT_VERSION_NUMBER, SOFTWARE_VERSION_NUMBER,
+                                              conversion_options(compression, derive))
+    # Only this run's conversions are merged in, so a watcher converting into the same tree keeps its entries
+    manifest_sondes.merge_manifest(netcdf_dir, manifest, [manifest_sondes.manifest_key(raw_dir, result['file'])
+                                                          for result in summary if result['error'] is None])
+    with catalog_sondes.SondeCatalog(netcdf_dir) as catalog:
+        catalog.upsert(result['catalog'] for result in summary if result['error'] is None)
+    with index_sondes.SondeIndex(netcdf_dir) as index:
+        index.replace((result['output'], result['index']) for result in summary if result['error'] is None)
+
+    if profile_report is not None:
+        records = [record for result in summary for record in result.pop('profile')]
+        file_records = [record for record in records if record['stage'] == 'convert_file']
+        records.append({'stage': 'campaign', 'file': None, 'wall_s': time.perf_counter() - start,
+                        'rows': sum(record['rows'] or 0 for record in file_records),
+                        'bytes_read': sum(record['bytes_read'] or 0 for record in file_records),
+                        'bytes_written': sum(record['bytes_written'] or 0 for record in file_records),
+                        'peak_rss_mb': max([instrument_sondes.peak_rss_mb()]
+                                           + [record['peak_rss_mb'] for record in records])})
+        instrument_sondes.write_report(records, profile_report)
+
+    print_conversion_summary(summary)
+    return summary
+
+
+def print_conversion_summary(summary):
+    failures = [result for result in summary if result['error'] is not None]
+    print(f"Converted {len(summary) - len(failures)} of {len(summary)} sondes, {len(failures)} failed")
+    for result in failures:
+        print(f"  FAILED {result['file']}: {result['error']}")
 
 
 if __name__ == "__main__":
+    import argparse
     import sys
 
-    in_dir = sys.argv[1]
-    out_dir = sys.argv[2]
-    convert_sondes_to_netcdf(in_dir, out_dir)
+    parser = argparse.ArgumentParser(description='Convert WOEST Vaisala EDT radiosonde files to NetCDF.')
+    parser.add_argument('raw_dir', help='directory containing one sub-directory of EDT files per station')
+    parser.add_argument('netcdf_dir', help='root directory for the NetCDF output tree')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='number of worker processes to convert files with (default: 1, no pool)')
+    parser.add_argument('--incremental', action='store_true',
+                        help='only convert files that are new, have changed, or were converted with an older '
+                             'product/software version, according to the manifest in netcdf_dir')
+    parser.add_argument('--aggregate', choices=['station', 'campaign'],
+                        help='also write all sondes into one CF ragged-array trajectory file per station, or one '
+                             'for the whole campaign')
+    parser.add_argument('--compression', choices=sorted(COMPRESSION_PROFILES), default='default',
+                        help='NetCDF compression profile (default: shuffle + deflate level 4)')
+    parser.add_argument('--no-quantize', dest='quantize', action='store_false',
+                        help='store full float32 precision instead of quantising to sensor precision')
+    parser.add_argument('--chunk-size', type=int,
+                        help='chunk length along the time/obs dimension (default: chosen by the netCDF library)')
+    parser.add_argument('--variable-compression', action='append', default=[], metavar='VAR:KEY=VALUE[,...]',
+                        help='override the compression of one variable, e.g. air_pressure:least_significant_digit=3; '
+                             f"keys: {', '.join(VARIABLE_COMPRESSION_KEYS)} (repeatable)")
+    parser.add_argument('--derive', action='store_true',
+                        help='add dew point, potential and equivalent potential temperature, mixing ratio, u/v wind '
+                             'and surface parcel LCL/CAPE/CIN variables')
+    parser.add_argument('--profile-report',
+                        help='write per-stage, per-file wall time, rows, bytes and peak RSS to this .json or .csv file')
+    args = parser.parse_args()
+
+    try:
+        overrides = variable_compression_overrides(args.variable_compression)
+    except ValueError as error:
+        parser.error(str(error))
+    compression = NetcdfCompression(args.compression, quantize=args.quantize, chunk_size=args.chunk_size,
+                                    overrides=overrides)
+    summary = convert_sondes_to_netcdf(args.raw_dir, args.netcdf_dir, workers=args.workers,
+                                       incremental=args.incremental, compression=compression,
+                                       profile_report=args.profile_report, derive=args.derive)
+    if args.aggregate is not None:
+        summary += convert_sondes_to_campaign_netcdf(args.raw_dir, args.netcdf_dir, aggregate=args.aggregate,
+                                                     workers=args.workers, compression=compression,
+                                                     derive=args.derive)
+    sys.exit(1 if any(result['error'] is not None for result in summary) else 0)
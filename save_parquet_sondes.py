@@ -0,0 +1,150 @@
+import json
+import os
+
+import polars as pl
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from read_sondes import do_radiosondes, SONDE_COLUMN_TYPES
+import archive_sondes
+import save_netcdf_sondes
+from save_netcdf_sondes import SondeInfo, VARIABLE_COLUMNS, PRODUCT_VERSION_NUMBER, SOFTWARE_VERSION_NUMBER
+
+
+# Parquet output for analytics: the same renamed, unit-converted columns as the NetCDF files (epoch time, Kelvin
+# temperature, elapsed time), one file per sonde in a hive-partitioned tree
+#
+#     parquet_dir/station=ash-farm/year=2023/month=06/<same stem as the NetCDF file>.parquet
+#
+# so a whole campaign can be scanned with predicate pushdown and partition pruning (see scan_parquet_sondes).
+# Missing values are Parquet nulls rather than a fill value. The sonde metadata goes in the schema metadata and
+# the units in each field's metadata. Polars hands its buffers to Arrow without copying, and pyarrow writes
+# them, as polars' own writer can't attach schema metadata.
+
+# Units of the Parquet columns, matching the NetCDF variables
+PARQUET_UNITS = {
+    'time': 'seconds since 1970-01-01 00:00:00',
+    'altitude': 'm',
+    'latitude': 'degrees_north',
+    'longitude': 'degrees_east',
+    'air_pressure': 'hPa',
+    'air_temperature': 'K',
+    'relative_humidity': '%',
+    'wind_speed': 'm s-1',
+    'wind_from_direction': 'degree',
+    'upward_balloon_velocity': 'm s-1',
+    'elapsed_time': 's',
+}
+
+
+def parquet_file_path(parquet_dir, radiosonde_metadata):
+    sonde_system_info = SondeInfo(radiosonde_metadata['Station name'])
+    start_time_dt = radiosonde_metadata['start_time_dt']
+    parquet_filename = (f"{sonde_system_info.instrument_name}_{sonde_system_info.station_name.lower()}_"
+                        f"{start_time_dt:%Y%m%d-%H%M%S}_sonde_woest_{PRODUCT_VERSION_NUMBER}.parquet")
+    return os.path.join(parquet_dir, f"station={sonde_system_info.station_name}", f"year={start_time_dt:%Y}",
+                        f"month={start_time_dt:%m}", parquet_filename)
+
+
+def sonde_arrow_table(df, radiosonde_metadata, current_edt_filename):
+    # The prepared sonde as an Arrow table with its metadata attached. Columns that are already float32 are
+    # passed through without copying.
+    sonde_system_info = SondeInfo(radiosonde_metadata['Station name'])
+    df = save_netcdf_sondes.prepare_sonde_columns(df, radiosonde_metadata,
+                                                  recreate_elapsed_time=sonde_system_info.station_name == 'reading')
+    sonde_id = f"{sonde_system_info.station_name}_{radiosonde_metadata['start_time_dt']:%Y%m%d-%H%M%S}"
+    df = df.select(
+        [pl.lit(sonde_id).alias('sonde_id'), pl.col('EpochTime').alias('time')]
+        + [(pl.col(column) if df.schema[column] == pl.Float32 else pl.col(column).cast(pl.Float32))
+           .alias(variable_name)
+           for variable_name, column in VARIABLE_COLUMNS.items()]
+    )
+    table = df.to_arrow()
+
+    schema = pa.schema([field.with_metadata({'units': PARQUET_UNITS[field.name]})
+                        if field.name in PARQUET_UNITS else field for field in table.schema])
+    schema_metadata = {
+        'sonde_id': sonde_id,
+        'station_name': sonde_system_info.station_name,
+        'instrument_name': sonde_system_info.instrument_name,
+        'system_owner': sonde_system_info.system_owner,
+        'system_operator': sonde_system_info.system_operator,
+        'data_provider': sonde_system_info.data_provider,
+        'release_time': radiosonde_metadata['start_time_dt'].strftime('%Y-%m-%dT%H:%M:%S'),
+        'raw_data_file': current_edt_filename,
+        'product_version': PRODUCT_VERSION_NUMBER,
+        'processing_software_version': SOFTWARE_VERSION_NUMBER,
+        'radiosonde_metadata': json.dumps({key: value for key, value in radiosonde_metadata.items()
+                                           if isinstance(value, str)}, sort_keys=True),
+    }
+    return table.cast(schema.with_metadata(schema_metadata))
+
+
+def save_parquet_file(df, radiosonde_metadata, parquet_dir, current_edt_filename, compression='zstd'):
+    parquet_path = parquet_file_path(parquet_dir, radiosonde_metadata)
+    os.makedirs(os.path.dirname(parquet_path), exist_ok=True)
+    print(parquet_path)
+
+    table = sonde_arrow_table(df, radiosonde_metadata, current_edt_filename)
+    # Same atomic write as the NetCDF files: a reader never sees a half-written file
+    tmp_path = f"{parquet_path}.{os.getpid()}.tmp"
+    try:
+        pq.write_table(table, tmp_path, compression=compression)
+        os.replace(tmp_path, parquet_path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    return parquet_path
+
+
+def convert_sonde_file_to_parquet(current_edt_file, parquet_dir, compression='zstd'):
+    # Same contract as save_netcdf_sondes.convert_sonde_file, so it can run in the same process pool
+    result = {'file': current_edt_file, 'output': None, 'error': None}
+    try:
+        df, radiosonde_metadata, data_units = do_radiosondes(current_edt_file, parquet_dir,
+                                                             columns=list(SONDE_COLUMN_TYPES))
+        result['output'] = save_parquet_file(df, radiosonde_metadata, parquet_dir,
+                                             archive_sondes.edt_base_name(current_edt_file), compression)
+    except Exception as error:
+        result['error'] = f"{type(error).__name__}: {error}"
+    return result
+
+
+def convert_sondes_to_parquet(raw_dir, parquet_dir, workers=1, compression='zstd'):
+    summary = save_netcdf_sondes.run_sonde_jobs(convert_sonde_file_to_parquet,
+                                                save_netcdf_sondes.find_edt_files(raw_dir), workers, parquet_dir,
+                                                compression)
+    save_netcdf_sondes.print_conversion_summary(summary)
+    return summary
+
+
+def scan_parquet_sondes(parquet_dir):
+    # Lazily scan a whole Parquet tree. Filters on station, year and month prune whole directories; filters on
+    # the data columns are pushed down to the row group statistics.
+    return pl.scan_parquet(os.path.join(parquet_dir, '**', '*.parquet'), hive_partitioning=True)
+
+
+def read_parquet_metadata(parquet_path):
+    # The schema metadata of one sonde file, with the raw EDT header decoded back to a dict
+    metadata = {key.decode(): value.decode() for key, value in pq.read_schema(parquet_path).metadata.items()}
+    metadata['radiosonde_metadata'] = json.loads(metadata['radiosonde_metadata'])
+    return metadata
+
+
+if __name__ == "__main__":
+    import argparse
+    import sys
+
+    parser = argparse.ArgumentParser(description='Convert WOEST Vaisala EDT radiosonde files to partitioned Parquet.')
+    parser.add_argument('raw_dir', help='directory containing one sub-directory of EDT files per station')
+    parser.add_argument('parquet_dir', help='root directory for the station=/year=/month= Parquet tree')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='number of worker processes to convert files with (default: 1, no pool)')
+    parser.add_argument('--compression', choices=['zstd', 'snappy', 'gzip', 'lz4', 'none'], default='zstd',
+                        help='Parquet compression codec (default: zstd)')
+    args = parser.parse_args()
+
+    summary = convert_sondes_to_parquet(args.raw_dir, args.parquet_dir, workers=args.workers,
+                                        compression=args.compression)
+    sys.exit(1 if any(result['error'] is not None for result in summary) else 0)
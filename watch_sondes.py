@@ -0,0 +1,193 @@
+import asyncio
+import contextlib
+import time
+from concurrent.futures.process import BrokenProcessPool
+
+import archive_sondes
+import catalog_sondes
+import index_sondes
+import manifest_sondes
+import save_netcdf_sondes
+
+
+# Near-real-time ingestion for launch campaigns: watch every station directory for new EDT files and convert
+# each one as soon as it has finished uploading, without rescanning or reconverting the whole raw directory.
+#
+# A scanner polls the station directories and queues a file once its size and mtime have stopped changing for
+# settle_time seconds and the manifest says it needs converting. The queue is bounded, so if the workers fall
+# behind the scanner blocks instead of piling up work. Each worker hands its file to convert_sonde_file in a
+# process pool and records the result in the manifest, so a restarted daemon (or an --incremental batch run)
+# picks up where this one left off, and upserts its row in the sonde catalog. Its entry is merged into the
+# manifest on disk under a lock, so a batch run writing to the same tree doesn't lose entries or overwrite ours.
+# A file whose bookkeeping fails (say the catalog is locked by a batch run) is left out of the manifest and
+# converted again on a later poll.
+# If a worker process dies (killed for memory, or a crash in the netCDF/HDF5 libraries) the process pool is
+# broken for good, so it is replaced and the files it was converting go back to the scanner; a file that breaks
+# the pool MAX_POOL_BREAKS times is taken to be the cause and treated as failed.
+MAX_POOL_BREAKS = 2
+
+
+class SondeWatcher:
+
+    def __init__(self, raw_dir, netcdf_dir, poll_interval=5.0, settle_time=10.0, workers=2, queue_size=None,
+                 compression=None, derive=False):
+        self.raw_dir = raw_dir
+        self.netcdf_dir = netcdf_dir
+        self.poll_interval = poll_interval
+        self.settle_time = settle_time
+        self.workers = workers
+        self.queue_size = queue_size or 2 * workers
+        self.compression = compression
+        self.derive = derive
+        self.manifest = manifest_sondes.load_manifest(netcdf_dir)
+        # file -> (size, mtime_ns, time the size or mtime last changed)
+        self._seen = {}
+        # Files queued or being converted, and the (size, mtime_ns) of files that failed, which are only retried
+        # once they change
+        self._in_flight = set()
+        self._failed = {}
+        # The process pool, the stack of pools run() has opened, and how often each file's worker has died
+        self._pool = None
+        self._pools = None
+        self._pool_breaks = {}
+
+    def ready_files(self, now):
+        # Files that have stopped changing for settle_time and still need converting
+        ready = []
+        # Reloaded every poll to see what an --incremental batch run into the same tree has converted meanwhile
+        self.manifest = manifest_sondes.load_manifest(self.netcdf_dir)
+        # Archives still being copied in can't be listed yet; they are picked up on a later poll
+        for current_edt_file in save_netcdf_sondes.find_edt_files(self.raw_dir, skip_unreadable_archives=True):
+            try:
+                fingerprint = archive_sondes.source_size_mtime(current_edt_file)
+            except (OSError, KeyError):
+                continue
+            previous = self._seen.get(current_edt_file)
+            if previous is None or previous[:2] != fingerprint:
+                self._seen[current_edt_file] = fingerprint + (now,)
+                continue
+            if (now - previous[2] < self.settle_time or current_edt_file in self._in_flight
+                    or self._failed.get(current_edt_file) == fingerprint):
+                continue
+            if manifest_sondes.needs_conversion(self.manifest, self.raw_dir, current_edt_file,
+                                                save_netcdf_sondes.PRODUCT_VERSION_NUMBER,
+                                                save_netcdf_sondes.SOFTWARE_VERSION_NUMBER,
+                                                save_netcdf_sondes.conversion_options(self.compression, self.derive)):
+                ready.append(current_edt_file)
+        return ready
+
+    async def scan(self, queue, stop):
+        while not stop.is_set():
+            for current_edt_file in self.ready_files(time.monotonic()):
+                self._in_flight.add(current_edt_file)
+                # Blocks while the queue is full: backpressure from the workers
+                await queue.put(current_edt_file)
+            try:
+                await asyncio.wait_for(stop.wait(), self.poll_interval)
+            except asyncio.TimeoutError:
+                pass
+
+    def record(self, current_edt_file, result):
+        # Bookkeeping for a converted file: catalog and index first, the manifest last, so a file only counts as
+        # converted once everything about it has been saved
+        with catalog_sondes.SondeCatalog(self.netcdf_dir) as catalog:
+            catalog.upsert([result['catalog']])
+        with index_sondes.SondeIndex(self.netcdf_dir) as index:
+            index.replace([(result['output'], result['index'])])
+        manifest_sondes.record_conversion(self.manifest, self.raw_dir, current_edt_file, result['output'],
+                                          save_netcdf_sondes.PRODUCT_VERSION_NUMBER,
+                                          save_netcdf_sondes.SOFTWARE_VERSION_NUMBER,
+                                          save_netcdf_sondes.conversion_options(self.compression, self.derive))
+        manifest_sondes.merge_manifest(self.netcdf_dir, self.manifest,
+                                       [manifest_sondes.manifest_key(self.raw_dir, current_edt_file)])
+
+    def replace_pool(self, broken_pool):
+        # Every conversion running in a broken pool fails, so only the first to notice replaces it
+        if self._pool is broken_pool:
+            print("Worker process died, starting a new process pool")
+            self._pool = self._pools.enter_context(save_netcdf_sondes.sonde_process_pool(self.workers))
+
+    async def convert(self, queue):
+        # One worker loop. Nothing but cancellation may end it, or the files it would have taken stay queued and
+        # run() never returns.
+        loop = asyncio.get_running_loop()
+        while True:
+            current_edt_file = await queue.get()
+            try:
+                pool = self._pool
+                try:
+                    result = await loop.run_in_executor(pool, save_netcdf_sondes.convert_sonde_file,
+                                                        current_edt_file, self.netcdf_dir, self.compression, False,
+                                                        self.derive)
+                except BrokenProcessPool as error:
+                    self.replace_pool(pool)
+                    self._pool_breaks[current_edt_file] = self._pool_breaks.get(current_edt_file, 0) + 1
+                    if self._pool_breaks[current_edt_file] < MAX_POOL_BREAKS:
+                        # Not in _failed, so the scanner queues it again on its next poll
+                        print(f"RETRYING {current_edt_file}: {type(error).__name__}: {error}")
+                        continue
+                    result = {'file': current_edt_file, 'output': None, 'error': f"{type(error).__name__}: {error}"}
+                except Exception as error:
+                    # e.g. a worker process that died
+                    result = {'file': current_edt_file, 'output': None, 'error': f"{type(error).__name__}: {error}"}
+                if result['error'] is None:
+                    try:
+                        self.record(current_edt_file, result)
+                    except Exception as error:
+                        # e.g. the catalog locked by a batch run. Leave the file out of the manifest so the next
+                        # poll converts it again.
+                        self.manifest['files'].pop(manifest_sondes.manifest_key(self.raw_dir, current_edt_file),
+                                                   None)
+                        print(f"FAILED to record {current_edt_file}, will retry: {type(error).__name__}: {error}")
+                    else:
+                        self._failed.pop(current_edt_file, None)
+                        self._pool_breaks.pop(current_edt_file, None)
+                        print(f"{current_edt_file} -> {result['output']}")
+                else:
+                    self._failed[current_edt_file] = self._seen[current_edt_file][:2]
+                    self._pool_breaks.pop(current_edt_file, None)
+                    print(f"FAILED {current_edt_file}: {result['error']}")
+            finally:
+                self._in_flight.discard(current_edt_file)
+                queue.task_done()
+
+    async def run(self, stop=None):
+        # Watch until stop (an asyncio.Event) is set, then finish the files already queued
+        stop = stop or asyncio.Event()
+        queue = asyncio.Queue(maxsize=self.queue_size)
+        with contextlib.ExitStack() as self._pools:
+            self._pool = self._pools.enter_context(save_netcdf_sondes.sonde_process_pool(self.workers))
+            converters = [asyncio.create_task(self.convert(queue)) for _ in range(self.workers)]
+            try:
+                await self.scan(queue, stop)
+                await queue.join()
+            finally:
+                for converter in converters:
+                    converter.cancel()
+                await asyncio.gather(*converters, return_exceptions=True)
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Watch station directories and convert new EDT files to NetCDF '
+                                                 'as they arrive.')
+    parser.add_argument('raw_dir', help='directory containing one sub-directory of EDT files per station')
+    parser.add_argument('netcdf_dir', help='root directory for the NetCDF output tree')
+    parser.add_argument('--workers', type=int, default=2, help='number of worker processes (default: 2)')
+    parser.add_argument('--poll-interval', type=float, default=5.0,
+                        help='seconds between scans of the station directories (default: 5)')
+    parser.add_argument('--settle-time', type=float, default=10.0,
+                        help='seconds a file must stop changing before it is converted (default: 10)')
+    parser.add_argument('--queue-size', type=int, help='maximum files waiting for a worker (default: 2 x workers)')
+    parser.add_argument('--compression', choices=sorted(save_netcdf_sondes.COMPRESSION_PROFILES), default='default')
+    parser.add_argument('--derive', action='store_true', help='add the derived thermodynamic variables')
+    args = parser.parse_args()
+
+    watcher = SondeWatcher(args.raw_dir, args.netcdf_dir, poll_interval=args.poll_interval,
+                           settle_time=args.settle_time, workers=args.workers, queue_size=args.queue_size,
+                           compression=save_netcdf_sondes.NetcdfCompression(args.compression), derive=args.derive)
+    try:
+        asyncio.run(watcher.run())
+    except KeyboardInterrupt:
+        pass